@@ -0,0 +1,259 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, List
+from connection_manager import ConnectionManager
+from device_scanner import DeviceScanner, DiscoveredDevice
+from metrics import Counter
+
+if TYPE_CHECKING:
+    from bleak.backends.device import BLEDevice
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_FAILOVERS = Counter('nuki_adapter_failovers_total', 'Connections that failed on an adapter and were tried on the next one', ['adapter'])
+
+class AdapterSelector:
+    """
+    Picks the adapter for every device. An adapter pinned in the config wins,
+    otherwise the adapter that received the device with the best RSSI. The
+    choice only changes if another adapter is better by `hysteresis` dB, so
+    devices in between two adapters don't flip back and forth.
+    """
+
+    def __init__(self, adapters: List[str], pinned_adapter, max_age: float = 30, hysteresis: float = 5):
+        self.adapters = list(adapters)
+        self.__pinnedAdapter = pinned_adapter
+        self.__maxAge = max_age
+        self.__hysteresis = hysteresis
+        # address -> adapter -> (rssi, time)
+        self.__samples: Dict[str, Dict[str, tuple]] = {}
+        self.__nextPrune = 0.0
+        # Only filled for devices that have been looked up
+        self.__preferred: Dict[str, str] = {}
+
+    def on_advertisement(self, adapter: str, device: BLEDevice, advertisement_data):
+        now = time.monotonic()
+        self.__samples.setdefault(device.address.upper(), {})[adapter] = (advertisement_data.rssi, now)
+        if now >= self.__nextPrune:
+            self.__prune(now)
+
+    def __prune(self, now: float):
+        # Samples of every passing advertiser would pile up otherwise
+        samples = {}
+        for address, byAdapter in self.__samples.items():
+            recent = {a: sample for a, sample in byAdapter.items() if now - sample[1] <= self.__maxAge}
+            if recent:
+                samples[address] = recent
+        self.__samples = samples
+        self.__nextPrune = now + self.__maxAge
+
+    def rssi(self, address: str) -> Dict[str, int]:
+        """
+        Recent RSSI of the device per adapter that received it.
+        """
+        now = time.monotonic()
+        samples = self.__samples.get(address.upper(), {})
+        return {a: rssi for a, (rssi, t) in samples.items() if now - t <= self.__maxAge}
+
+    def preferred(self, address: str) -> str:
+        key = address.upper()
+        pinned = self.__pinnedAdapter(key)
+        if pinned in self.adapters:
+            return pinned
+
+        rssi = self.rssi(key)
+        current = self.__preferred.get(key)
+        if rssi:
+            best = max(rssi, key=rssi.get)
+            if current not in rssi or rssi[best] - rssi[current] >= self.__hysteresis:
+                current = self.__preferred[key] = best
+
+        return current if current is not None else self.adapters[0]
+
+    def candidates(self, address: str) -> List[str]:
+        """
+        Adapters to try for the device: the preferred one, then the others that
+        have received the device by RSSI, then the rest.
+        """
+        preferred = self.preferred(address)
+        rssi = self.rssi(address)
+        others = sorted((a for a in self.adapters if a != preferred), key=lambda a: -rssi.get(a, -1000))
+        return [preferred] + others
+
+    def is_known(self, address: str) -> bool:
+        return bool(self.rssi(address)) or self.__pinnedAdapter(address.upper()) in self.adapters
+
+class MultiAdapterScanner:
+    """
+    One DeviceScanner per adapter behind the interface of a single one.
+    Lookups go to the scanner of the adapter the device is assigned to.
+    """
+
+    def __init__(self, scanners: Dict[str, DeviceScanner], selector: AdapterSelector):
+        self.__scanners = scanners
+        self.__selector = selector
+        for adapter, scanner in scanners.items():
+            scanner.add_listener(lambda device, advertisement_data, adapter=adapter:
+                selector.on_advertisement(adapter, device, advertisement_data))
+
+    @property
+    def is_running(self) -> bool:
+        return any(s.is_running for s in self.__scanners.values())
+
+    async def start(self):
+        errors = []
+        for adapter, scanner in self.__scanners.items():
+            try:
+                await scanner.start()
+            except Exception as e:
+                logger.error(f"Could not start scanner on adapter {adapter or 'default'}: {e}")
+                errors.append(e)
+
+        if len(errors) == len(self.__scanners):
+            raise errors[0]
+
+    async def stop(self):
+        for scanner in self.__scanners.values():
+            await scanner.stop()
+
+    def add_listener(self, callback):
+        for scanner in self.__scanners.values():
+            scanner.add_listener(callback)
+
+    def remove_listener(self, callback):
+        for scanner in self.__scanners.values():
+            scanner.remove_listener(callback)
+
+    def get_device(self, address: str, adapter: str = None) -> BLEDevice:
+        entry = self.get_entry(address, adapter)
+        return entry.device if entry else None
+
+    def get_entry(self, address: str, adapter: str = None) -> DiscoveredDevice:
+        if adapter is not None:
+            return self.__scanners[adapter].get_entry(address)
+
+        for adapter in self.__selector.candidates(address):
+            entry = self.__scanners[adapter].get_entry(address)
+            if entry is not None:
+                return entry
+        return None
+
+    def get_entries(self) -> List[DiscoveredDevice]:
+        return self.__merge(e for s in self.__scanners.values() for e in s.get_entries())
+
+    async def find_device_by_address(self, device_identifier: str, timeout: float = 10.0, adapter: str = None) -> BLEDevice:
+        if adapter is not None:
+            return await self.__scanners[adapter].find_device_by_address(device_identifier, timeout)
+
+        if self.__selector.is_known(device_identifier):
+            adapter = self.__selector.preferred(device_identifier)
+            return await self.__scanners[adapter].find_device_by_address(device_identifier, timeout)
+
+        # Never seen before, take whichever adapter finds it first
+        tasks = [asyncio.ensure_future(s.find_device_by_address(device_identifier, timeout)) for s in self.__scanners.values()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                device = await task
+                if device is not None:
+                    return device
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def discover(self, timeout: float = 5.0, callback=None) -> List[DiscoveredDevice]:
+        # Every device is reported once, by the adapter that sees it first
+        reported = set()
+        def report(entry: DiscoveredDevice):
+            key = entry.device.address.upper()
+            if key not in reported:
+                reported.add(key)
+                callback(entry)
+
+        results = await asyncio.gather(*[s.discover(timeout, report if callback else None) for s in self.__scanners.values()],
+            return_exceptions=True)
+        for adapter, result in zip(self.__scanners, results):
+            if isinstance(result, Exception):
+                logger.error(f"Scan on adapter {adapter or 'default'} failed: {result}")
+
+        entries = [e for r in results if not isinstance(r, Exception) for e in r]
+        if entries or not all(isinstance(r, Exception) for r in results):
+            return self.__merge(entries)
+        raise results[0]
+
+    @staticmethod
+    def __merge(entries) -> List[DiscoveredDevice]:
+        # Keep the best reception of every device
+        best: Dict[str, DiscoveredDevice] = {}
+        for entry in entries:
+            key = entry.device.address.upper()
+            if key not in best or entry.rssi > best[key].rssi:
+                best[key] = entry
+        return list(best.values())
+
+class MultiAdapterConnectionManager:
+    """
+    One ConnectionManager per adapter, so every adapter has its own budget
+    of open links. A device is connected through its preferred adapter and
+    through the next candidate if that fails.
+    """
+
+    def __init__(self, managers: Dict[str, ConnectionManager], selector: AdapterSelector):
+        self.__managers = managers
+        self.__selector = selector
+        # address -> adapters its reservations were made on
+        self.__reservations: Dict[str, List[str]] = {}
+
+    @contextlib.asynccontextmanager
+    async def connection(self, address: str):
+        async with contextlib.AsyncExitStack() as stack:
+            device = None
+            candidates = self.__selector.candidates(address)
+            for index, adapter in enumerate(candidates):
+                # Only one adapter may hold a link to the device
+                for other, manager in self.__managers.items():
+                    if other != adapter:
+                        await manager.close(address)
+
+                try:
+                    device = await stack.enter_async_context(self.__managers[adapter].connection(address))
+                    break
+                except Exception as e:
+                    if index == len(candidates) - 1:
+                        raise
+                    logger.warning(f"Could not connect to {address} through adapter {adapter or 'default'}, trying the next one: {e}")
+                    ADAPTER_FAILOVERS.inc(adapter=adapter or 'default')
+
+            yield device
+
+    def adapter(self, address: str) -> str:
+        return self.__selector.preferred(address)
+
+    def try_reserve(self, address: str) -> bool:
+        # The slot is taken on the adapter the device is assigned to right now
+        adapter = self.__selector.preferred(address)
+        if not self.__managers[adapter].try_reserve(address):
+            return False
+        self.__reservations.setdefault(address.upper(), []).append(adapter)
+        return True
+
+    def release_reservation(self, address: str):
+        adapters = self.__reservations.get(address.upper())
+        if adapters:
+            self.__managers[adapters.pop()].release_reservation(address)
+            if not adapters:
+                del self.__reservations[address.upper()]
+
+    def is_open(self, address: str) -> bool:
+        return any(m.is_open(address) for m in self.__managers.values())
+
+    async def close(self, address: str):
+        for manager in self.__managers.values():
+            await manager.close(address)
+
+    async def close_all(self):
+        for manager in self.__managers.values():
+            await manager.close_all()
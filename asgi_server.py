@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import inspect
+import io
+import logging
+import sys
+from flask import Flask
+from werkzeug.exceptions import InternalServerError
+
+logger = logging.getLogger(__name__)
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    """
+    Translate an ASGI http scope into a WSGI environ for Flask.
+    """
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = server[0]
+    environ['SERVER_PORT'] = str(server[1] or 80)
+
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+    return environ
+
+class FlaskASGIAdapter:
+    """
+    Serves a Flask app through ASGI. Async views are awaited directly on the
+    server loop instead of a private loop per request, so they can share
+    state with everything else running on that loop. Sync views (swagger UI,
+    static files) run in the default executor.
+
+    `on_startup` and `on_shutdown` are coroutine functions that are awaited
+    on the lifespan events.
+    """
+
+    def __init__(self, app: Flask, on_startup=None, on_shutdown=None):
+        self.__app = app
+        self.__onStartup = on_startup
+        self.__onShutdown = on_shutdown
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.__lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.__http(scope, receive, send)
+        else:
+            raise RuntimeError(f"Unsupported ASGI scope type {scope['type']}")
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if self.__onStartup is not None:
+                        await self.__onStartup()
+                except Exception as e:
+                    logger.exception(e)
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    if self.__onShutdown is not None:
+                        await self.__onShutdown()
+                except Exception as e:
+                    logger.exception(e)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+
+        app = self.__app
+        with app.request_context(build_environ(scope, bytes(body))) as ctx:
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await self.__dispatch(ctx)
+                    response = app.make_response(rv)
+                except Exception as e:
+                    response = app.make_response(app.handle_user_exception(e))
+                response = app.process_response(response)
+            except Exception as e:
+                try:
+                    response = app.handle_exception(e)
+                except Exception:
+                    logger.exception(e)
+                    response = app.response_class(InternalServerError.description, status=500)
+
+            await self.__send_response(response, send, receive)
+
+    async def __dispatch(self, ctx):
+        app = self.__app
+        request = ctx.request
+        if request.routing_exception is not None:
+            app.raise_routing_exception(request)
+
+        rule = request.url_rule
+        if getattr(rule, 'provide_automatic_options', False) and request.method == 'OPTIONS':
+            return app.make_default_options_response()
+
+        view = app.view_functions[rule.endpoint]
+        if inspect.iscoroutinefunction(view):
+            return await view(**request.view_args)
+
+        # Run blocking views in a thread, with the request context copied over
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: context.run(view, **request.view_args))
+
+    async def __send_response(self, response, send, receive):
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+        try:
+            if not response.is_streamed:
+                await send({'type': 'http.response.body', 'body': response.get_data()})
+                return
+
+            if hasattr(response.response, '__aiter__'):
+                await self.__send_async_stream(response.response, send, receive)
+                return
+
+            loop = asyncio.get_running_loop()
+            chunks = iter(response.iter_encoded())
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            response.close()
+
+    async def __send_async_stream(self, chunks, send, receive):
+        async def send_chunks():
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        # Endless streams only end when the client goes away
+        sender = asyncio.ensure_future(send_chunks())
+        watcher = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            sender.cancel()
+            await asyncio.gather(sender, watcher, return_exceptions=True)
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+
+        if not sender.cancelled() and sender.exception() is not None:
+            raise sender.exception()
@@ -0,0 +1,330 @@
+"""
+Benchmarks of the REST API and the job queue against simulated locks.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json --threshold 0.2
+
+Exits with 1 if a scenario got slower than the baseline by more than the
+threshold.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+# Metrics where a higher value is a regression, all others regress when they drop
+LOWER_IS_BETTER = ('p50', 'p95', 'p99', 'writesPerRequest')
+HIGHER_IS_BETTER = ('throughput',)
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # Peak instead of current usage, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, float]:
+    count = len(latencies) + errors
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50': round(percentile(latencies, 50), 4),
+        'p95': round(percentile(latencies, 95), 4),
+        'p99': round(percentile(latencies, 99), 4),
+        'mean': round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        'throughput': round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        'elapsed': round(elapsed, 3),
+        'rssMB': round(rss_mb(), 1),
+    }
+
+def lock_address(index: int) -> str:
+    return '54:D2:72:{:02X}:{:02X}:{:02X}'.format(index >> 16 & 0xFF, index >> 8 & 0xFF, index & 0xFF)
+
+class RestBench:
+    """
+    The REST server with `device_count` paired simulated locks, called
+    in-process through the Flask test client.
+    """
+
+    def __init__(self, args, device_count: int, **config_overrides):
+        import restserver
+
+        logging.getLogger().setLevel(logging.WARNING)
+        self.server = restserver
+        self.addresses = [lock_address(i + 1) for i in range(device_count)]
+        self.configWrites = 0
+        self.__clients = threading.local()
+        self.__tmpDir = tempfile.mkdtemp(prefix='nuki-bench-')
+
+        restserver.configPath = os.path.join(self.__tmpDir, 'config.json')
+        config = restserver.default_config()
+        config.update({
+            'backend': 'simulator',
+            'maxConcurrentJobs': args.radio_concurrency,
+            'simulatedDevices': [{
+                'address': address,
+                'connectLatency': args.connect_latency,
+                'stateLatency': args.state_latency,
+                'actionLatency': args.action_latency,
+                'failureRate': args.failure_rate,
+                'advertisementInterval': args.advertisement_interval,
+            } for address in self.addresses],
+            'pairedDevices': [{
+                'address': address,
+                'authId': base64.b64encode(os.urandom(4)).decode('utf-8'),
+                'devicePublicKey': base64.b64encode(os.urandom(32)).decode('utf-8'),
+            } for address in self.addresses],
+        })
+        config.update(config_overrides)
+        restserver.save_config(restserver.configPath, config)
+
+        # Count the writes of the settings file
+        save_config = restserver.save_config
+        def counting_save_config(file_path, config):
+            self.configWrites += 1
+            save_config(file_path, config)
+        self.__saveConfig = save_config
+        restserver.save_config = counting_save_config
+
+        restserver.init_services(config)
+        restserver.start_services()
+
+        # Let the background scanner see every lock once
+        time.sleep(args.advertisement_interval * 2)
+
+    def close(self):
+        self.server.stop_services()
+        self.server.save_config = self.__saveConfig
+        shutil.rmtree(self.__tmpDir, ignore_errors=True)
+
+    def call(self, method: str, path: str, **kwargs) -> Tuple[float, bool]:
+        client = getattr(self.__clients, 'client', None)
+        if client is None:
+            client = self.__clients.client = self.server.app.test_client()
+
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        return time.perf_counter() - start, response.status_code == 200
+
+    def run(self, requests: List[Callable[[], Tuple[float, bool]]], concurrency: int) -> Dict[str, float]:
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for latency, ok in executor.map(lambda request: request(), requests):
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+        return summarize(latencies, errors, time.perf_counter() - start)
+
+def lock_request(bench: RestBench, address: str, action: str):
+    return lambda: bench.call('POST', f'/{action}', json={'address': address})
+
+def state_request(bench: RestBench, address: str, max_age: float):
+    return lambda: bench.call('GET', f'/state?address={address}&maxAge={max_age}')
+
+def bench_single_lock(args) -> Dict[str, float]:
+    bench = RestBench(args, 1)
+    try:
+        address = bench.addresses[0]
+        requests = [lock_request(bench, address, 'lock' if i % 2 else 'unlock') for i in range(args.requests)]
+        return bench.run(requests, 1)
+    finally:
+        bench.close()
+
+def bench_mixed(args) -> Dict[str, float]:
+    bench = RestBench(args, args.locks)
+    try:
+        rnd = random.Random(args.seed)
+        requests = []
+        for _ in range(args.requests):
+            address = rnd.choice(bench.addresses)
+            if rnd.random() < args.state_share:
+                requests.append(state_request(bench, address, args.max_age))
+            else:
+                requests.append(lock_request(bench, address, rnd.choice(('lock', 'unlock'))))
+        return bench.run(requests, args.concurrency)
+    finally:
+        bench.close()
+
+def bench_list_paired(args) -> Dict[str, float]:
+    bench = RestBench(args, args.paired)
+    try:
+        requests = [lambda: bench.call('GET', '/listPaired') for _ in range(args.iterations)]
+        return bench.run(requests, 1)
+    finally:
+        bench.close()
+
+def bench_config_writes(args) -> Dict[str, float]:
+    bench = RestBench(args, args.locks, configSaveDelay=args.save_delay)
+    try:
+        writesBefore = bench.configWrites
+        requests = [state_request(bench, bench.addresses[i % len(bench.addresses)], 0) for i in range(args.requests)]
+        result = bench.run(requests, args.concurrency)
+
+        # Include the write of the last debounce window
+        bench.server.registry.flush()
+        result['configWrites'] = bench.configWrites - writesBefore
+        result['writesPerRequest'] = round(result['configWrites'] / max(1, result['requests']), 4)
+        return result
+    finally:
+        bench.close()
+
+def bench_queue_burst(args) -> Dict[str, float]:
+    from job_queue import JobQueue, JobQueueFullError
+
+    queue = JobQueue(max_concurrency=args.radio_concurrency, max_queue_depth=args.queue_depth)
+    queue.start()
+
+    async def job():
+        await asyncio.sleep(args.job_time)
+
+    async def submit_all():
+        # Submitted all at once from the caller loop, like a burst of requests
+        handles = []
+        rejected = 0
+        for i in range(args.burst):
+            try:
+                handles.append((time.perf_counter(), queue.submit_job(job, lane=i % args.locks)))
+            except JobQueueFullError:
+                rejected += 1
+
+        async def wait(start, handle):
+            await handle
+            return time.perf_counter() - start
+        latencies = await asyncio.gather(*[wait(start, handle) for start, handle in handles])
+        return list(latencies), rejected
+
+    try:
+        start = time.perf_counter()
+        latencies, rejected = asyncio.run(submit_all())
+        result = summarize(latencies, 0, time.perf_counter() - start)
+        result['rejected'] = rejected
+        result['accepted'] = len(latencies)
+        return result
+    finally:
+        queue.stop()
+
+SCENARIOS = {
+    'single_lock': bench_single_lock,
+    'mixed': bench_mixed,
+    'list_paired': bench_list_paired,
+    'queue_burst': bench_queue_burst,
+    'config_writes': bench_config_writes,
+}
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict[str, any], baseline: Dict[str, any], threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if metric not in result or not old.get(metric):
+                continue
+
+            change = (result[metric] - old[metric]) / old[metric]
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append(f"{name}.{metric}: {old[metric]} -> {result[metric]} ({change:+.0%})")
+
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the REST API and the job queue against simulated locks.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios to run')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative regression against the baseline')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per REST scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--locks', type=int, default=8, help='Simulated locks for the mixed workload')
+    parser.add_argument('--paired', type=int, default=50, help='Paired locks for /listPaired')
+    parser.add_argument('--iterations', type=int, default=10, help='Calls of /listPaired')
+    parser.add_argument('--state-share', type=float, default=0.7, help='Share of /state in the mixed workload')
+    parser.add_argument('--max-age', type=float, default=0, help='maxAge of the /state requests')
+    parser.add_argument('--radio-concurrency', type=int, default=3, help='maxConcurrentJobs of the server')
+    parser.add_argument('--save-delay', type=float, default=0.5, help='configSaveDelay for the config write scenario')
+    parser.add_argument('--burst', type=int, default=1000, help='Jobs submitted at once to the job queue')
+    parser.add_argument('--queue-depth', type=int, default=100, help='maxQueueDepth of the job queue')
+    parser.add_argument('--job-time', type=float, default=0.005, help='Seconds each burst job takes')
+    parser.add_argument('--connect-latency', type=float, default=0.05)
+    parser.add_argument('--state-latency', type=float, default=0.02)
+    parser.add_argument('--action-latency', type=float, default=0.1)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--advertisement-interval', type=float, default=0.1)
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'scenarios': {},
+    }
+
+    for name in [n.strip() for n in args.scenarios.split(',') if n.strip()]:
+        if name not in SCENARIOS:
+            print(f"Unknown scenario {name}, choose from {', '.join(SCENARIOS)}", file=sys.stderr)
+            return 2
+
+        print(f"Running {name}...", file=sys.stderr)
+        result = results['scenarios'][name] = SCENARIOS[name](args)
+        print(f"  {json.dumps(result)}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
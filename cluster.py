@@ -0,0 +1,389 @@
+import asyncio
+import contextlib
+import fcntl
+import http.client
+import importlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import urllib.parse
+from typing import Dict, List, Tuple
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_SYNCS = Counter('nuki_cluster_syncs_total', 'Exchanges of paired devices and node reports with the cluster store', ['result'])
+CLUSTER_FORWARDS = Counter('nuki_cluster_forwards_total', 'Requests handed to the node that owns the device', ['result'])
+
+# Config keys the locks know this server by, all nodes have to share them
+IDENTITY_KEYS = ('appId', 'appName', 'privateKey', 'publicKey')
+
+# Fields of a paired device that only apply to this node, e.g. the adapter it is pinned to
+LOCAL_KEYS = ('adapter',)
+
+# Fields the keys of a device are derived from, open links have to be dropped if they change
+AUTH_KEYS = ('authId', 'devicePublicKey')
+
+# Set on forwarded requests, so that they are executed by the node receiving them
+FORWARDED_HEADER = 'X-Nuki-Forwarded-By'
+
+class ClusterStore:
+    """
+    Key value store shared by the nodes of a cluster, values are anything
+    that can be serialized as JSON. Other backends, e.g. Redis, derive from
+    this class and are selected with `clusterStore` set to `module:Class`.
+    """
+
+    def get(self, key: str):
+        raise NotImplementedError
+
+    def put(self, key: str, value):
+        raise NotImplementedError
+
+    def put_if_absent(self, key: str, value):
+        """
+        Store `value` unless the key exists, returns the stored value.
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def scan(self, prefix: str) -> Dict[str, any]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FileClusterStore(ClusterStore):
+    """
+    All keys in one JSON file, e.g. on a share mounted by every node. Writers
+    take an exclusive lock on a file next to it.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        with open(self.__path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __read(self) -> Dict[str, any]:
+        try:
+            with open(self.__path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def __write(self, data: Dict[str, any]):
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.__path)
+
+    def get(self, key: str):
+        with self.__locked():
+            return self.__read().get(key)
+
+    def put(self, key: str, value):
+        with self.__locked():
+            data = self.__read()
+            data[key] = value
+            self.__write(data)
+
+    def put_if_absent(self, key: str, value):
+        with self.__locked():
+            data = self.__read()
+            if key not in data:
+                data[key] = value
+                self.__write(data)
+            return data[key]
+
+    def delete(self, key: str):
+        with self.__locked():
+            data = self.__read()
+            if data.pop(key, None) is not None:
+                self.__write(data)
+
+    def scan(self, prefix: str) -> Dict[str, any]:
+        with self.__locked():
+            return {k: v for k, v in self.__read().items() if k.startswith(prefix)}
+
+class SqliteClusterStore(ClusterStore):
+    """
+    Keys in an SQLite database. Stands in for a networked store like Redis
+    on a single host or a share that supports SQLite's file locking.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.__connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    @contextlib.contextmanager
+    def __connect(self):
+        # One connection per call, the store is used from several threads
+        with contextlib.closing(sqlite3.connect(self.__path, timeout=10)) as db:
+            with db:
+                yield db
+
+    def get(self, key: str):
+        with self.__connect() as db:
+            row = db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, value):
+        with self.__connect() as db:
+            db.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def put_if_absent(self, key: str, value):
+        with self.__connect() as db:
+            db.execute('INSERT OR IGNORE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+            row = db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0])
+
+    def delete(self, key: str):
+        with self.__connect() as db:
+            db.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def scan(self, prefix: str) -> Dict[str, any]:
+        with self.__connect() as db:
+            rows = db.execute('SELECT key, value FROM kv WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+def create_store(name: str, path: str) -> ClusterStore:
+    """
+    `file` or `sqlite` at `path`, `module:Class` creates a store of that
+    class with `path` as its only argument.
+    """
+    if name == 'file':
+        return FileClusterStore(path)
+    if name == 'sqlite':
+        return SqliteClusterStore(path)
+    module, _, cls = name.partition(':')
+    if not cls:
+        raise ValueError(f"Unknown cluster store {name}, use file, sqlite or module:Class")
+    return getattr(importlib.import_module(module), cls)(path)
+
+def shared(entry: dict) -> dict:
+    """
+    The fields of a paired device that all nodes share.
+    """
+    return {k: v for k, v in entry.items() if k not in LOCAL_KEYS}
+
+class ClusterNode:
+    """
+    Shares the paired devices of `registry` with the other nodes through
+    `store` and reports every `interval` seconds with which RSSI this node
+    receives them. A device is owned by the node pinned in its entry, e.g.
+    `"node": "gateway-2"`, or else by the node receiving it best. Ownership
+    only moves to a node that is better by `hysteresis` dB. Nodes that
+    haven't reported for `node_ttl` seconds are left out.
+
+    `rssi(address)` is the RSSI this node receives the device with, None if
+    it can't reach it. `on_device_changed(address)` is called for devices
+    that were paired again or removed by another node.
+    """
+
+    def __init__(self, store: ClusterStore, node_id: str, url: str, registry, rssi, on_device_changed,
+                 interval: float = 10, node_ttl: float = 30, hysteresis: float = 5):
+        self.store = store
+        self.nodeId = node_id
+        self.url = url.rstrip('/')
+        self.__registry = registry
+        self.__rssi = rssi
+        self.__onDeviceChanged = on_device_changed
+        self.__interval = interval
+        self.__nodeTtl = node_ttl
+        self.__hysteresis = hysteresis
+        self.__nodes: Dict[str, dict] = {}
+        self.__owners: Dict[str, str] = {}
+        # Paired devices as last seen in the store
+        self.__published: Dict[str, dict] = {}
+        self.__task = None
+
+    def join(self, config: Dict[str, any]) -> bool:
+        """
+        Share the identity of this node if it is the first one, otherwise
+        take over the identity of the cluster. Returns whether the config
+        has changed and needs to be saved.
+        """
+        local = {key: config[key] for key in IDENTITY_KEYS}
+        founding = self.store.get('identity') is None
+        identity = self.store.put_if_absent('identity', local)
+        changed = identity != local
+        if changed:
+            stored = self.__store_devices()
+            foreign = [e['address'] for e in self.__registry.entries() if self.__registry.normalize(e['address']) not in stored]
+            if foreign:
+                raise RuntimeError(f"Devices {', '.join(foreign)} have been paired with the key of this node, which differs from the "
+                    "key of the cluster. Unpair them or remove them from the settings before joining.")
+            logger.info(f"Node {self.nodeId} takes over the identity of the cluster")
+            config.update(identity)
+        elif founding:
+            # Bring in the pairings of the node that starts the cluster, later the store is authoritative
+            for entry in self.__registry.entries():
+                self.store.put(f'devices/{self.__registry.normalize(entry["address"])}', shared(entry))
+
+        self.__pull(notify=False)
+        return changed
+
+    def publish(self, entries: List[dict]):
+        """
+        Write the changes to the paired devices of this node to the store.
+        Called by the registry while it holds its save lock.
+        """
+        current = {self.__registry.normalize(e['address']): shared(e) for e in entries}
+        for key, entry in current.items():
+            if self.__published.get(key) != entry:
+                self.store.put(f'devices/{key}', entry)
+        for key in set(self.__published) - set(current):
+            self.store.delete(f'devices/{key}')
+        self.__published = {key: dict(e) for key, e in current.items()}
+
+    def sync(self):
+        """
+        Report to the store and pick up the devices and reports of the other
+        nodes. Blocking, runs in an executor.
+        """
+        rssi = {}
+        for entry in self.__registry.entries():
+            value = self.__rssi(entry['address'])
+            if value is not None:
+                rssi[self.__registry.normalize(entry['address'])] = value
+        self.store.put(f'nodes/{self.nodeId}', {'id': self.nodeId, 'url': self.url, 'rssi': rssi, 'reportedAt': time.time()})
+        self.__pull(notify=True)
+
+    def __pull(self, notify: bool):
+        # A save in between could publish entries older than the ones read here
+        with self.__registry.save_lock:
+            # Local changes go out first, so that they aren't overwritten
+            self.__registry.flush()
+            devices = self.__store_devices()
+            self.__published = {key: dict(e) for key, e in devices.items()}
+
+            local = {self.__registry.normalize(e['address']): e for e in self.__registry.entries()}
+            merged = [{**e, **{k: local[key][k] for k in LOCAL_KEYS if k in local.get(key, {})}} for key, e in devices.items()]
+            # Only pairing again or unpairing makes the keys in use outdated, not e.g. a new name
+            changed = [key for key in set(devices) | set(local) if key not in devices or key not in local or
+                any(devices[key].get(k) != local[key].get(k) for k in AUTH_KEYS)]
+            self.__registry.replace_all(merged)
+        if notify:
+            for address in changed:
+                self.__onDeviceChanged(address)
+
+        self.__nodes = {node['id']: node for node in self.store.scan('nodes/').values()}
+
+    def __store_devices(self) -> Dict[str, dict]:
+        return {self.__registry.normalize(e['address']): e for e in self.store.scan('devices/').values()}
+
+    def nodes(self) -> List[dict]:
+        now = time.time()
+        return [node for node in self.__nodes.values() if node['id'] != self.nodeId and now - node['reportedAt'] <= self.__nodeTtl]
+
+    def owner(self, address: str) -> dict:
+        """
+        The node that handles the device, None if it is this one.
+        """
+        key = self.__registry.normalize(address)
+        nodes = {node['id']: node for node in self.nodes()}
+        pinned = (self.__registry.get(key) or {}).get('node')
+        if pinned == self.nodeId:
+            return None
+        if pinned in nodes:
+            return nodes[pinned]
+
+        rssi = {id: node['rssi'][key] for id, node in nodes.items() if key in node['rssi']}
+        local = self.__rssi(key)
+        if local is not None:
+            rssi[self.nodeId] = local
+        current = self.__owners.get(key)
+        if rssi:
+            best = max(rssi, key=rssi.get)
+            if current not in rssi or rssi[best] - rssi[current] >= self.__hysteresis:
+                current = self.__owners[key] = best
+
+        # Nobody reaches the device, try it ourselves
+        return nodes.get(current)
+
+    def status(self) -> Dict[str, any]:
+        now = time.time()
+        nodes = [{'id': self.nodeId, 'url': self.url, 'self': True}] + \
+            [{'id': node['id'], 'url': node['url'], 'age': round(now - node['reportedAt'], 1), 'rssi': node['rssi']} for node in self.nodes()]
+        devices = {}
+        for entry in self.__registry.entries():
+            owner = self.owner(entry['address'])
+            devices[entry['address']] = owner['id'] if owner is not None else self.nodeId
+        return {'node': self.nodeId, 'nodes': nodes, 'owners': devices}
+
+    async def start(self):
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.sync)
+                CLUSTER_SYNCS.inc(result='ok')
+            except Exception as e:
+                logger.warning(f"Could not sync with the cluster store: {e}")
+                CLUSTER_SYNCS.inc(result='error')
+            await asyncio.sleep(self.__interval)
+
+class ForwardError(Exception):
+    """
+    The node has received a forwarded request but didn't answer it. It may
+    have executed the command, so it must not be executed again elsewhere.
+    """
+
+    def __init__(self, message: str, timed_out: bool):
+        super().__init__(message)
+        self.timed_out = timed_out
+
+def forward(url: str, method: str, path: str, body: bytes, headers: Dict[str, str], timeout: float) -> Tuple[int, bytes, Dict[str, str]]:
+    """
+    Send a request to another node. Error responses are returned like any
+    other. A ConnectionError is raised if the node can't be reached, before
+    anything has been sent, a ForwardError if it failed to answer.
+    """
+    target = urllib.parse.urlsplit(url)
+    cls = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+    connection = cls(target.hostname, target.port, timeout=timeout)
+    try:
+        try:
+            connection.connect()
+        except OSError as e:
+            raise ConnectionError(f"Node {url} is not reachable: {e}") from e
+
+        try:
+            connection.request(method, target.path.rstrip('/') + path, body=body or None, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read(), dict(response.headers)
+        except socket.timeout as e:
+            raise ForwardError(f"Node {url} did not answer within {timeout} seconds", True) from e
+        except (OSError, http.client.HTTPException) as e:
+            raise ForwardError(f"Node {url} did not answer: {e}", False) from e
+    finally:
+        connection.close()
@@ -0,0 +1,236 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Dict
+from metrics import Counter, Histogram
+import tracing
+
+logger = logging.getLogger(__name__)
+
+BLE_OPERATION_SECONDS = Histogram('nuki_ble_operation_seconds', 'Time spent on BLE operations per device', ['operation', 'address'])
+CONNECTION_REQUESTS = Counter('nuki_connection_requests_total', 'Requests served by an open connection or a new one', ['result'])
+RECONNECTS = Counter('nuki_reconnects_total', 'Connections that had to be set up again after an error', ['address'])
+
+class _Connection:
+    def __init__(self, key: str):
+        self.key = key
+        self.device = None
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.lastUsed = time.monotonic()
+        self.idleTimer = None
+
+class ConnectionManager:
+    """
+    Keeps one connected NukiDevice per address open across requests. Idle
+    links are closed after `idle_timeout` seconds, at most `max_connections`
+    links are open at the same time. All methods have to be called from the
+    job queue loop.
+
+    `keep_warm` (see KeepWarmPolicy) may extend the idle timeout per device
+    and is told about warm hits and idle times.
+    """
+
+    def __init__(self, device_factory, idle_timeout: float = 20, max_connections: int = 3, keep_warm=None):
+        self.__deviceFactory = device_factory
+        self.__idleTimeout = idle_timeout
+        self.__keepWarm = keep_warm
+        self.__maxConnections = max(1, max_connections)
+        self.__connections = {}
+        # Devices of jobs that have been started and may need a link, see try_reserve()
+        self.__reserved: Dict[str, int] = {}
+        self.__released = asyncio.Condition()
+        self.__tasks = set()
+
+    @contextlib.asynccontextmanager
+    async def connection(self, address: str):
+        entry = await self.__acquire(address)
+        failed = False
+        try:
+            yield entry.device
+        except BaseException:
+            # A cancelled operation leaves the link in an unknown state too
+            failed = True
+            raise
+        finally:
+            await self.__release(entry, failed)
+
+    def try_reserve(self, address: str) -> bool:
+        """
+        Claim a link slot for a job about to start, so that it doesn't wait
+        for one while it holds its place in the job queue. Links nobody uses
+        count as free, they are closed when the slot is needed. Has to be
+        followed by release_reservation().
+        """
+        key = address.upper()
+        busy = {k for k, e in self.__connections.items() if e.users > 0} | set(self.__reserved)
+        if key not in busy and len(busy) >= self.__maxConnections:
+            return False
+        self.__reserved[key] = self.__reserved.get(key, 0) + 1
+        return True
+
+    def release_reservation(self, address: str):
+        key = address.upper()
+        count = self.__reserved.get(key, 0) - 1
+        if count > 0:
+            self.__reserved[key] = count
+        else:
+            self.__reserved.pop(key, None)
+
+    def is_open(self, address: str) -> bool:
+        entry = self.__connections.get(address.upper())
+        return entry is not None and entry.device is not None
+
+    async def close(self, address: str):
+        entry = self.__connections.get(address.upper())
+        if entry is not None:
+            await self.__close_entry(entry)
+            await self.__notify_released()
+
+    async def close_all(self):
+        for entry in list(self.__connections.values()):
+            await self.__close_entry(entry)
+        await self.__notify_released()
+
+    async def __acquire(self, address: str) -> _Connection:
+        key = address.upper()
+        entry = self.__connections.get(key)
+        if entry is None:
+            await self.__reserve_slot()
+            entry = self.__connections.setdefault(key, _Connection(key))
+
+        entry.users += 1
+        if entry.idleTimer is not None:
+            entry.idleTimer.cancel()
+            entry.idleTimer = None
+            self.__idle_end(entry)
+
+        try:
+            await entry.lock.acquire()
+        except BaseException:
+            # Cancelled while waiting for the link
+            entry.users -= 1
+            if entry.users == 0:
+                await self.__close_entry(entry)
+                await self.__notify_released()
+            raise
+
+        warm = entry.device is not None
+        try:
+            await self.__connect(entry, address)
+        except BaseException:
+            # Also when cancelled, so that the link doesn't stay locked forever
+            entry.users -= 1
+            await self.__hand_over(entry, True)
+            raise
+
+        if self.__keepWarm is not None:
+            self.__keepWarm.on_connection(entry.key, warm)
+
+        return entry
+
+    async def __connect(self, entry: _Connection, address: str):
+        if entry.device is None:
+            logger.info(f"Opening connection to {address}...")
+            CONNECTION_REQUESTS.inc(result='miss')
+            entry.device = await self.__deviceFactory(address)
+            with BLE_OPERATION_SECONDS.time(operation='connect', address=entry.key), tracing.span('connect', address=entry.key):
+                await self.__connect_device(entry, address)
+        else:
+            logger.info(f"Reusing connection to {address}")
+            CONNECTION_REQUESTS.inc(result='hit')
+            with tracing.span('connect', address=entry.key, reused=True):
+                await self.__connect_device(entry, address)
+
+    async def __connect_device(self, entry: _Connection, address: str):
+        try:
+            # Returns immediately if the link is still up
+            await entry.device.connect()
+        except Exception as e:
+            # The link was lost and could not be restored with the old BLE device,
+            # start over with a freshly resolved one
+            logger.warning(f"Reconnecting to {address} after error: {e}")
+            RECONNECTS.inc(address=entry.key)
+            await entry.device.disconnect()
+            entry.device = await self.__deviceFactory(address)
+            await entry.device.connect()
+
+    async def __release(self, entry: _Connection, failed: bool):
+        entry.users -= 1
+        entry.lastUsed = time.monotonic()
+        await self.__hand_over(entry, failed)
+
+    async def __hand_over(self, entry: _Connection, failed: bool):
+        # Called holding the lock of the entry, whose users have been counted down already
+        try:
+            if failed and entry.users > 0:
+                # Start with a fresh link after errors, the entry stays for the callers waiting for it
+                await self.__disconnect(entry)
+        finally:
+            entry.lock.release()
+
+        idleTimeout = self.__idleTimeout
+        if self.__keepWarm is not None:
+            idleTimeout = self.__keepWarm.idle_timeout(entry.key, idleTimeout)
+
+        if entry.users == 0:
+            if failed or idleTimeout <= 0:
+                await self.__close_entry(entry)
+            else:
+                # Closing an idle link is not part of the request that used it last
+                entry.idleTimer = asyncio.get_running_loop().call_later(idleTimeout, self.__expire, entry, context=contextvars.Context())
+
+        await self.__notify_released()
+
+    def __idle_end(self, entry: _Connection):
+        if self.__keepWarm is not None:
+            self.__keepWarm.on_idle_end(entry.key, time.monotonic() - entry.lastUsed)
+
+    def __expire(self, entry: _Connection):
+        entry.idleTimer = None
+        self.__idle_end(entry)
+        if entry.users > 0 or self.__connections.get(entry.key) is not entry:
+            return
+
+        logger.info(f"Closing idle connection to {entry.key}")
+        task = asyncio.create_task(self.__close_idle(entry))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __close_idle(self, entry: _Connection):
+        await self.__close_entry(entry)
+        await self.__notify_released()
+
+    async def __reserve_slot(self):
+        async with self.__released:
+            while len(self.__connections) >= self.__maxConnections:
+                idle = [e for e in self.__connections.values() if e.users == 0]
+                if idle:
+                    # Make room by closing the least recently used idle link
+                    await self.__close_entry(min(idle, key=lambda e: e.lastUsed))
+                else:
+                    await self.__released.wait()
+
+    async def __close_entry(self, entry: _Connection):
+        if self.__connections.get(entry.key) is entry:
+            del self.__connections[entry.key]
+
+        if entry.idleTimer is not None:
+            entry.idleTimer.cancel()
+            entry.idleTimer = None
+            self.__idle_end(entry)
+
+        async with entry.lock:
+            await self.__disconnect(entry)
+
+    async def __disconnect(self, entry: _Connection):
+        if entry.device is not None:
+            with BLE_OPERATION_SECONDS.time(operation='disconnect', address=entry.key), tracing.span('disconnect', address=entry.key):
+                await entry.device.disconnect()
+            entry.device = None
+
+    async def __notify_released(self):
+        async with self.__released:
+            self.__released.notify_all()
@@ -0,0 +1,36 @@
+import threading
+from metrics import Counter
+
+DEVICE_CACHE_REQUESTS = Counter('nuki_device_cache_requests_total', 'Device objects reused or newly created', ['result'])
+
+class DeviceHandleCache:
+    """
+    One long-lived device object per paired address. Creating it decodes the
+    key material and derives the shared secret, so this is done only once
+    until the pairing changes.
+    """
+
+    def __init__(self, device_factory):
+        self.__deviceFactory = device_factory
+        self.__devices = {}
+        self.__lock = threading.Lock()
+
+    def get(self, address: str):
+        key = address.upper()
+        with self.__lock:
+            device = self.__devices.get(key)
+            if device is None:
+                DEVICE_CACHE_REQUESTS.inc(result='miss')
+                device = self.__deviceFactory(address)
+                self.__devices[key] = device
+            else:
+                DEVICE_CACHE_REQUESTS.inc(result='hit')
+            return device
+
+    def invalidate(self, address: str):
+        with self.__lock:
+            self.__devices.pop(address.upper(), None)
+
+    def clear(self):
+        with self.__lock:
+            self.__devices.clear()
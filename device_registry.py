@@ -0,0 +1,123 @@
+import contextvars
+import copy
+import logging
+import threading
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+class DeviceRegistry:
+    """
+    Paired devices of the config, indexed by their normalized address.
+    Changes are written back through `save` after `save_delay` seconds so
+    that bursts of updates end up in a single write.
+    """
+
+    def __init__(self, config: Dict[str, any], save, save_delay: float = 5):
+        self.__config = config
+        self.__save = save
+        self.__saveDelay = save_delay
+        self.__lock = threading.RLock()
+        self.__saveLock = threading.RLock()
+        self.__dirty = False
+        self.__saveTimer = None
+        self.__index: Dict[str, dict] = {}
+
+        for entry in config.setdefault('pairedDevices', []):
+            self.__index[self.normalize(entry['address'])] = entry
+
+    @property
+    def save_lock(self) -> threading.RLock:
+        # Held while the entries are saved, changes from elsewhere take it to stay in step with the saves
+        return self.__saveLock
+
+    @staticmethod
+    def normalize(address: str) -> str:
+        return address.upper()
+
+    def get(self, address: str) -> dict:
+        if not address:
+            return None
+        return self.__index.get(self.normalize(address))
+
+    def entries(self) -> List[dict]:
+        with self.__lock:
+            return list(self.__config['pairedDevices'])
+
+    def add_or_replace(self, entry: dict):
+        key = self.normalize(entry['address'])
+        with self.__lock:
+            pairedDevices = self.__config['pairedDevices']
+            old = self.__index.get(key)
+            if old is not None:
+                pairedDevices[pairedDevices.index(old)] = entry
+            else:
+                pairedDevices.append(entry)
+            self.__index[key] = entry
+            self.mark_dirty()
+
+    def remove(self, address: str) -> bool:
+        with self.__lock:
+            entry = self.__index.pop(self.normalize(address), None)
+            if entry is None:
+                return False
+            self.__config['pairedDevices'].remove(entry)
+            self.mark_dirty()
+            return True
+
+    def replace_all(self, entries: List[dict]) -> List[str]:
+        """
+        Take over the paired devices from elsewhere, e.g. the cluster store.
+        Returns the addresses of the devices that were added, changed or
+        removed.
+        """
+        with self.__lock:
+            index = {self.normalize(e['address']): e for e in entries}
+            changed = [key for key in set(index) | set(self.__index) if index.get(key) != self.__index.get(key)]
+            if changed:
+                self.__config['pairedDevices'][:] = list(index.values())
+                self.__index = index
+                self.mark_dirty()
+            return changed
+
+    def update_info(self, address: str, name: str, id: int) -> dict:
+        with self.__lock:
+            entry = self.get(address)
+            if entry is None:
+                raise LookupError(f'Device with address {address} has not been paired yet.')
+
+            if entry.get('name') != name or entry.get('id') != id:
+                entry['name'] = name
+                entry['id'] = id
+                self.mark_dirty()
+
+            return entry
+
+    def mark_dirty(self):
+        with self.__lock:
+            self.__dirty = True
+            if self.__saveTimer is None:
+                # The write shows up in the trace of the request that caused it
+                self.__saveTimer = threading.Timer(self.__saveDelay, contextvars.copy_context().run, [self.flush])
+                self.__saveTimer.daemon = True
+                self.__saveTimer.start()
+
+    def flush(self):
+        with self.__saveLock:
+            with self.__lock:
+                if self.__saveTimer is not None:
+                    self.__saveTimer.cancel()
+                    self.__saveTimer = None
+
+                if not self.__dirty:
+                    return
+
+                # Written outside of the lock, so that readers don't wait for the disk
+                snapshot = copy.deepcopy(self.__config)
+                self.__dirty = False
+
+            try:
+                self.__save(snapshot)
+            except Exception as e:
+                logger.error(f"Could not save config, trying again in {self.__saveDelay} seconds: {e}")
+                self.mark_dirty()
@@ -0,0 +1,229 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, List, Set
+from metrics import Counter, Histogram
+from startup import LazyModule
+
+if TYPE_CHECKING:
+    from bleak.backends.device import BLEDevice
+    from bleak.backends.scanner import AdvertisementData
+
+# Imported when the first scanner starts
+bleak = LazyModule('bleak')
+
+logger = logging.getLogger(__name__)
+
+SCAN_SECONDS = Histogram('nuki_scan_seconds', 'Time spent looking for devices', ['operation'])
+SCAN_CACHE_REQUESTS = Counter('nuki_scan_cache_requests_total', 'Device lookups answered from the scan cache or not', ['result'])
+
+class DiscoveredDevice:
+    def __init__(self, device: BLEDevice, rssi: int, lastSeen: float):
+        self.device = device
+        self.rssi = rssi
+        self.lastSeen = lastSeen
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.lastSeen
+
+class DeviceScanner:
+    """
+    Long running BLE scanner that keeps the latest advertisement of every
+    device in range. Has to be started and used on the job queue loop.
+    `scanner_class` can replace BleakScanner (the default), e.g. with a
+    simulation.
+    `adapter` selects the HCI adapter (e.g. 'hci1'), None uses the default.
+    """
+
+    def __init__(self, max_age: float = 30, scanner_class=None, adapter: str = None):
+        self.__maxAge = max_age
+        self.__scannerClass = scanner_class
+        self.__scannerArgs = {'adapter': adapter} if adapter else {}
+        self.__devices: Dict[str, DiscoveredDevice] = {}
+        self.__nextPrune = 0.0
+        self.__waiters: Dict[str, Set[asyncio.Event]] = {}
+        self.__listeners = []
+        self.__scanner = None
+        self.__scannerStarted = 0.0
+        # Scan shared by concurrent discover() calls while the background scanner is not running
+        self.__session = None
+        self.__sessionEnd = 0.0
+
+    @property
+    def is_running(self) -> bool:
+        return self.__scanner is not None
+
+    def __scanner_class(self):
+        return self.__scannerClass or bleak.BleakScanner
+
+    async def start(self):
+        if self.__scanner is not None:
+            return
+
+        scanner = self.__scanner_class()(detection_callback=self.__on_advertisement, **self.__scannerArgs)
+        await scanner.start()
+        self.__scanner = scanner
+        self.__scannerStarted = time.monotonic()
+        logger.info("Background scanner started")
+
+    async def stop(self):
+        if self.__scanner is None:
+            return
+
+        scanner, self.__scanner = self.__scanner, None
+        await scanner.stop()
+        logger.info("Background scanner stopped")
+
+    def add_listener(self, callback):
+        """
+        Register `callback(device, advertisement_data)` to be called for every
+        received advertisement.
+        """
+        self.__listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.__listeners:
+            self.__listeners.remove(callback)
+
+    def get_device(self, address: str) -> BLEDevice:
+        entry = self.get_entry(address)
+        return entry.device if entry else None
+
+    def get_entry(self, address: str) -> DiscoveredDevice:
+        entry = self.__devices.get(address.upper())
+        if entry is None:
+            return None
+
+        if entry.age > self.__maxAge:
+            self.__devices.pop(address.upper(), None)
+            return None
+
+        return entry
+
+    def get_entries(self) -> List[DiscoveredDevice]:
+        return [e for e in self.__devices.values() if e.age <= self.__maxAge]
+
+    async def find_device_by_address(self, device_identifier: str, timeout: float = 10.0) -> BLEDevice:
+        device = self.get_device(device_identifier)
+        if device is not None:
+            SCAN_CACHE_REQUESTS.inc(result='hit')
+            return device
+
+        SCAN_CACHE_REQUESTS.inc(result='miss')
+        with SCAN_SECONDS.time(operation='find'):
+            return await self.__find_device(device_identifier, timeout)
+
+    async def __find_device(self, device_identifier: str, timeout: float) -> BLEDevice:
+        logger.info(f"Device {device_identifier} not in scan cache, scanning...")
+        if self.__scanner is None:
+            return await self.__scanner_class().find_device_by_address(device_identifier, timeout=timeout, **self.__scannerArgs)
+
+        # Wait for the background scanner to pick the device up
+        key = device_identifier.upper()
+        waiter = asyncio.Event()
+        self.__waiters.setdefault(key, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.__waiters.get(key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.__waiters[key]
+
+        return self.get_device(device_identifier)
+
+    async def discover(self, timeout: float = 5.0, callback=None) -> List[DiscoveredDevice]:
+        """
+        Devices seen within the last `timeout` seconds. If the background
+        scanner has been running for that long, the answer comes right away
+        from the scan cache, otherwise concurrent callers share one scan. A
+        timeout of 0 returns every device in the scan cache.
+
+        `callback(entry)` is called for every device as soon as it has been
+        seen, once per device.
+        """
+        with SCAN_SECONDS.time(operation='discover'):
+            return await self.__discover(timeout, callback)
+
+    async def __discover(self, timeout: float, callback) -> List[DiscoveredDevice]:
+        # Collected as they come in, entries older than the scan cache keeps them may be pruned meanwhile
+        seen: Dict[str, DiscoveredDevice] = {}
+        def report(entry: DiscoveredDevice):
+            key = entry.device.address.upper()
+            if callback is not None and key not in seen:
+                callback(entry)
+            seen[key] = entry
+
+        if timeout <= 0:
+            entries = self.get_entries()
+            for entry in entries:
+                report(entry)
+            return entries
+
+        now = time.monotonic()
+        windowEnd = max(now, self.__scannerStarted + timeout) if self.__scanner is not None else now + timeout
+        since = windowEnd - timeout
+        for entry in list(self.__devices.values()):
+            if entry.lastSeen >= since:
+                report(entry)
+
+        listener = lambda device, advertisement_data: report(self.__devices[device.address.upper()])
+        self.add_listener(listener)
+        try:
+            if self.__scanner is not None:
+                await asyncio.sleep(windowEnd - now)
+            else:
+                await self.__join_session(windowEnd)
+        finally:
+            self.remove_listener(listener)
+
+        return list(seen.values())
+
+    async def __join_session(self, end: float):
+        # Extend the running scan instead of fighting over the radio
+        self.__sessionEnd = max(self.__sessionEnd, end)
+        if self.__session is None:
+            self.__session = asyncio.ensure_future(self.__run_session())
+
+        session = self.__session
+        done, _ = await asyncio.wait({session}, timeout=max(0.0, end - time.monotonic()))
+        if session in done:
+            session.result()
+
+    async def __run_session(self):
+        try:
+            scanner = self.__scanner_class()(detection_callback=self.__on_advertisement, **self.__scannerArgs)
+            await scanner.start()
+            try:
+                while self.__sessionEnd > time.monotonic():
+                    await asyncio.sleep(self.__sessionEnd - time.monotonic())
+            finally:
+                await scanner.stop()
+        finally:
+            self.__session = None
+
+    def __on_advertisement(self, device: BLEDevice, advertisement_data: AdvertisementData):
+        key = device.address.upper()
+        now = time.monotonic()
+        self.__devices[key] = DiscoveredDevice(device, advertisement_data.rssi, now)
+        if now >= self.__nextPrune:
+            self.__prune(now)
+
+        for waiter in self.__waiters.pop(key, ()):
+            waiter.set()
+
+        for listener in self.__listeners:
+            try:
+                listener(device, advertisement_data)
+            except Exception as e:
+                logger.exception(e)
+
+    def __prune(self, now: float):
+        # Devices that went away, e.g. phones with rotating addresses, would pile up otherwise
+        self.__devices = {k: e for k, e in self.__devices.items() if now - e.lastSeen <= self.__maxAge}
+        self.__nextPrune = now + self.__maxAge
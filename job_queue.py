@@ -1,55 +1,464 @@
-# job_queue.py
-
 import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import math
 import threading
-from concurrent.futures import Future as ThreadFuture
+import time
+from collections import deque
+from concurrent.futures import Future as ThreadFuture, InvalidStateError
+from metrics import Counter, Histogram
+import tracing
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SECONDS = Histogram('nuki_job_queue_wait_seconds', 'Time jobs spent queued before they were started', ['priority'])
+EXECUTION_SECONDS = Histogram('nuki_job_execution_seconds', 'Time jobs took to execute', ['priority'])
+JOB_ERRORS = Counter('nuki_job_errors_total', 'Jobs that failed, by exception type', ['type'])
+
+# Returned by the scheduler if no lane may start a job right now. None can't
+# be used as it is the key of the default lane.
+_NO_LANE = object()
+
+# Monotonic time by which the job running in this context has to be done
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+class JobSupersededError(Exception):
+    pass
+
+class JobCancelledError(Exception):
+    pass
+
+class JobQueueFullError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _Job:
+    def __init__(self, sequence: int, priority: int, lane, job, args, kwargs, coalesce_key, supersede_group):
+        self.sequence = sequence
+        self.priority = priority
+        self.lane = lane
+        self.job = job
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesceKey = coalesce_key
+        self.supersedeGroup = supersede_group
+        self.handles = []
+        # Context of the submitter, so that the job continues its trace
+        self.context = contextvars.copy_context()
+        self.startTime = None
+        self.endTime = None
+        self.group = None
+
+    def deadline(self) -> float:
+        # The job may run as long as any of its callers is willing to wait
+        deadlines = [h.deadline for h in self.handles if not h.future.cancelled()]
+        if not deadlines or None in deadlines:
+            return None
+        return max(deadlines)
+
+class JobHandle:
+    """
+    Awaitable result of a submitted job. Several handles share one execution
+    if their commands have been coalesced.
+    """
+
+    def __init__(self, job: _Job, timeout: float = None, run_timeout: float = None):
+        self.__job = job
+        self.future = ThreadFuture()
+        self.submitTime = time.monotonic()
+        self.deadline = self.submitTime + timeout if timeout is not None else None
+        self.runTimeout = run_timeout if timeout is None else None
+        if job.startTime is not None:
+            self.start()
+        job.handles.append(self)
+
+    def start(self):
+        # The time limit of a run_timeout begins once the job is running
+        if self.runTimeout is not None:
+            self.deadline = time.monotonic() + self.runTimeout
+
+    @property
+    def coalesced(self) -> int:
+        # Number of other submissions served by the same execution
+        return len(self.__job.handles) - 1
+
+    @property
+    def started(self) -> bool:
+        return self.__job.startTime is not None
+
+    @property
+    def wait_time(self) -> float:
+        startTime = self.__job.startTime if self.__job.startTime is not None else time.monotonic()
+        return max(0.0, startTime - self.submitTime)
+
+    @property
+    def execution_time(self) -> float:
+        if self.__job.startTime is None:
+            return 0.0
+        endTime = self.__job.endTime if self.__job.endTime is not None else time.monotonic()
+        return endTime - max(self.__job.startTime, self.submitTime)
+
+    def __await__(self):
+        future = asyncio.wrap_future(self.future)
+        if self.deadline is None:
+            return future.__await__()
+
+        # Giving up cancels the job if it is still queued
+        return asyncio.wait_for(future, max(0.0, self.deadline - time.monotonic())).__await__()
 
 class JobQueue:
-    def __init__(self):
-        self.__job_queue = asyncio.Queue()
+    # Lane key for jobs that need the whole radio (e.g. scanning or pairing).
+    # An exclusive job waits until all other lanes are idle and keeps them
+    # from starting new jobs until it has finished.
+    EXCLUSIVE = '*'
+
+    # Priority classes, lower values are served first
+    PRIORITY_ACTUATION = 0
+    PRIORITY_STATUS = 1
+    PRIORITY_MAINTENANCE = 2
+
+    def __init__(self, max_concurrency: int = 3, max_queue_depth: int = 100, lane_group=None, reserve=None, release=None):
+        """
+        At most `max_concurrency` lanes of the same group run at the same
+        time, `lane_group(lane)` tells the group of a lane (e.g. the adapter
+        of a device), all lanes share one group without it. `reserve(lane)`
+        is asked before a job of the lane is started and may refuse, e.g.
+        while no connection slot is free, `release(lane)` is called once the
+        job has finished. Both are called on the queue loop.
+        """
+        self.__lanes = {}
+        self.__queuedCount = 0
+        self.__maxQueueDepth = max(1, max_queue_depth)
+        self.__averageExecutionTime = 1.0
+        self.__runningJobs = {}
+        self.__tasks = set()
+        self.__lock = threading.Lock()
+        self.__sequence = itertools.count()
+        self.__wakeup = asyncio.Event()
+        self.__maxConcurrency = max(1, max_concurrency)
+        self.__laneGroup = lane_group or (lambda lane: None)
+        self.__reserve = reserve or (lambda lane: True)
+        self.__release = release or (lambda lane: None)
+        self.__stats = {'submitted': 0, 'executed': 0, 'coalesced': 0, 'superseded': 0, 'cancelled': 0, 'rejected': 0, 'timedOut': 0}
         self.__loop = None
         self.__isRunning = False
         self.__stopFlag = True
         self.__dispatchThread = None
+        self.__dispatchTask = None
+        self.__drainDeadline = 0
+        self.__shutdownHooks = []
 
     async def __dispatcher(self):
         while not self.__stopFlag:
-            job, args, kwargs, future = await self.__job_queue.get()
+            entry = self.__take_next_job()
+            if entry is None:
+                if not self.__isRunning:
+                    # Shutting down, wait for the queue to drain
+                    with self.__lock:
+                        if (not self.__lanes and not self.__runningJobs) or time.monotonic() > self.__drainDeadline:
+                            break
+                    await asyncio.sleep(0.1)
+                    continue
 
-            try:
-                if asyncio.iscoroutinefunction(job):
-                    result = await job(*args, **kwargs)
+                await self.__wakeup.wait()
+                self.__wakeup.clear()
+                continue
+
+            # The task runs in a copy of the context it is created in
+            task = entry.context.run(asyncio.create_task, self.__run_job(entry))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    def __take_next_job(self) -> _Job:
+        with self.__lock:
+            while True:
+                lane = self.__next_lane()
+                if lane is _NO_LANE:
+                    return None
+
+                entry = self.__lanes[lane].popleft()
+                self.__queuedCount -= 1
+                if not self.__lanes[lane]:
+                    del self.__lanes[lane]
+
+                # Skip jobs whose callers have all given up waiting while they were queued
+                if not [h for h in entry.handles if h.future.set_running_or_notify_cancel()]:
+                    self.__stats['cancelled'] += 1
+                    if lane != self.EXCLUSIVE:
+                        self.__release(lane)
+                    continue
+
+                entry.startTime = time.monotonic()
+                for handle in entry.handles:
+                    handle.start()
+                entry.group = self.__laneGroup(lane) if lane != self.EXCLUSIVE else None
+                self.__runningJobs[lane] = entry
+                QUEUE_WAIT_SECONDS.observe(entry.startTime - min(h.submitTime for h in entry.handles), priority=entry.priority)
+                return entry
+
+    def __next_lane(self):
+        if self.EXCLUSIVE in self.__runningJobs:
+            return _NO_LANE
+
+        # Jobs queued after a pending exclusive job have to wait for it, unless they are more important
+        exclusiveRank = self.__lane_rank(self.EXCLUSIVE) if self.EXCLUSIVE in self.__lanes else None
+
+        # Start the most important lane first, then the one waiting the longest. A lane is as
+        # important as the most important job queued in it, as its jobs can only run in order.
+        # Lanes whose group is busy or that can't get their resources don't hold up the others.
+        idleLanes = sorted((l for l in self.__lanes if l not in self.__runningJobs and l != self.EXCLUSIVE), key=self.__lane_rank)
+        running = [j.group for j in self.__runningJobs.values()]
+        for lane in idleLanes:
+            if exclusiveRank is not None and self.__lane_rank(lane) > exclusiveRank:
+                break
+            if running.count(self.__laneGroup(lane)) < self.__maxConcurrency and self.__reserve(lane):
+                return lane
+
+        # Drain the running lanes before handing over the radio
+        if exclusiveRank is not None and not self.__runningJobs:
+            return self.EXCLUSIVE
+        return _NO_LANE
+
+    def __lane_rank(self, lane):
+        jobs = self.__lanes[lane]
+        return min(j.priority for j in jobs), jobs[0].sequence
+
+    async def __run_job(self, entry: _Job):
+        result = None
+        exception = None
+        try:
+            tracing.record('queue', entry.startTime - min(h.submitTime for h in entry.handles), lane=str(entry.lane), priority=entry.priority)
+            with tracing.span(entry.job.__name__, lane=str(entry.lane), priority=entry.priority, coalesced=len(entry.handles) - 1):
+                deadline = entry.deadline()
+                _current_deadline.set(deadline)
+                if asyncio.iscoroutinefunction(entry.job):
+                    coro = entry.job(*entry.args, **entry.kwargs)
                 else:
                     # Run the synchronous job in an executor
-                    result = await self.__loop.run_in_executor(None, job, *args, **kwargs)
+                    coro = self.__loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, entry.job, *entry.args, **entry.kwargs))
+
+                # Cancel the job once no caller waits for it anymore so it frees its lane
+                if deadline is not None:
+                    result = await asyncio.wait_for(coro, max(0.0, deadline - time.monotonic()))
+                else:
+                    result = await coro
+        except asyncio.TimeoutError as e:
+            self.__stats['timedOut'] += 1
+            exception = e
+        except asyncio.CancelledError:
+            exception = JobCancelledError('Job has been cancelled')
+        except Exception as e:
+            exception = e
+        finally:
+            with self.__lock:
+                entry.endTime = time.monotonic()
+                del self.__runningJobs[entry.lane]
+                if entry.lane != self.EXCLUSIVE:
+                    self.__release(entry.lane)
+                self.__stats['executed'] += 1
+                self.__averageExecutionTime = 0.9 * self.__averageExecutionTime + 0.1 * (entry.endTime - entry.startTime)
+                handles = list(entry.handles)
+            self.__wakeup.set()
+
+        EXECUTION_SECONDS.observe(entry.endTime - entry.startTime, priority=entry.priority)
+        if exception is not None:
+            JOB_ERRORS.inc(type=type(exception).__name__)
+
+        for handle in handles:
+            self.__resolve(handle.future, result, exception)
+
+    @staticmethod
+    def __resolve(future: ThreadFuture, result=None, exception: Exception = None):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
                 future.set_result(result)
-            except Exception as e:
-                future.set_exception(e)
-    
-    def start(self):
+        except InvalidStateError:
+            # The caller has given up waiting
+            pass
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """
+        Start dispatching jobs. By default the queue runs its own event loop
+        in a separate thread. If `loop` is given, it has to be the running
+        loop of the calling thread and the queue runs as a task on it.
+        """
         if self.__isRunning:
             return
-        
+
         self.__isRunning = True
         self.__stopFlag = False
-        self.__dispatchThread = threading.Thread(target=self.__run_loop)
-        self.__dispatchThread.start()
+        if loop is not None:
+            self.__loop = loop
+            self.__dispatchTask = loop.create_task(self.__run())
+        else:
+            self.__loop = asyncio.new_event_loop()
+            self.__dispatchThread = threading.Thread(target=self.__run_loop)
+            self.__dispatchThread.start()
 
-    def stop(self):
+    def stop(self, drain_timeout: float = 10):
+        """
+        Stop accepting jobs, give the queued ones `drain_timeout` seconds to
+        finish, cancel the rest and run the shutdown hooks.
+        """
         if not self.__isRunning:
             return
-        
+
+        self.__drainDeadline = time.monotonic() + drain_timeout
         self.__isRunning = False
-        self.__stopFlag = True
+        self.__loop.call_soon_threadsafe(self.__wakeup.set)
         self.__dispatchThread.join()
 
+    async def async_stop(self, drain_timeout: float = 10):
+        """
+        Same as stop() for a queue that has been started on a given loop.
+        """
+        if not self.__isRunning:
+            return
+
+        self.__drainDeadline = time.monotonic() + drain_timeout
+        self.__isRunning = False
+        self.__wakeup.set()
+        await self.__dispatchTask
+
+    def add_shutdown_hook(self, hook):
+        """
+        Register a coroutine function that is awaited on the queue loop when
+        the queue stops, e.g. to close open connections.
+        """
+        self.__shutdownHooks.append(hook)
 
     def __run_loop(self):
-        self.__loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.__loop)
-        self.__loop.run_until_complete(self.__dispatcher())
+        self.__loop.run_until_complete(self.__run())
+        self.__loop.close()
+
+    async def __run(self):
+        await self.__dispatcher()
+        await self.__shutdown()
+
+    async def __shutdown(self):
+        self.__stopFlag = True
+
+        with self.__lock:
+            lanes, self.__lanes = self.__lanes, {}
+            self.__queuedCount = 0
+
+        for jobs in lanes.values():
+            for entry in jobs:
+                for handle in entry.handles:
+                    self.__resolve(handle.future, exception=JobCancelledError('Job queue has been stopped'))
+
+        tasks = list(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for hook in self.__shutdownHooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.exception(e)
+
+    def submit_job(self, job, *args, lane=None, priority: int = PRIORITY_STATUS, timeout: float = None, run_timeout: float = None,
+                   coalesce_key=None, supersede_group=None, **kwargs) -> JobHandle:
+        """
+        Queue a job in the given lane. Jobs of the same lane run strictly in
+        submission order, different lanes run concurrently up to the
+        configured limit. Jobs without a lane share one default lane.
+
+        With a `timeout` the caller gets an asyncio.TimeoutError after that
+        many seconds. The job is dropped if it has not started yet, or
+        cancelled if no other caller waits for it anymore. A `run_timeout`
+        instead only limits the time the job runs, not the time it is queued.
+
+        A job with a `coalesce_key` shares the execution of the latest job of
+        its lane if that one has the same function and key. A job with a
+        `supersede_group` replaces all queued jobs of its lane in that group,
+        whose callers then get a JobSupersededError.
+
+        If `max_queue_depth` jobs are waiting already, a JobQueueFullError is
+        raised right away, unless a less important job can be dropped instead.
+        """
+        if not self.__isRunning:
+            raise JobCancelledError('Job queue is not running')
+
+        with self.__lock:
+            self.__stats['submitted'] += 1
+            queued = self.__lanes.get(lane) or deque()
+
+            # Only the latest job of the lane may be joined, otherwise the order of intents would change
+            latest = queued[-1] if queued else self.__runningJobs.get(lane)
+            if coalesce_key is not None and latest is not None and latest.job == job and latest.coalesceKey == coalesce_key:
+                self.__stats['coalesced'] += 1
+                return JobHandle(latest, timeout, run_timeout)
+
+            if supersede_group is not None:
+                for old in [j for j in queued if j.supersedeGroup == supersede_group and j.job == job]:
+                    queued.remove(old)
+                    self.__queuedCount -= 1
+                    self.__stats['superseded'] += 1
+                    for handle in old.handles:
+                        self.__resolve(handle.future, exception=JobSupersededError('Command has been superseded by a later one'))
+
+            if self.__queuedCount >= self.__maxQueueDepth:
+                self.__shed_job(priority)
+
+            entry = _Job(next(self.__sequence), priority, lane, job, args, kwargs, coalesce_key, supersede_group)
+            handle = JobHandle(entry, timeout, run_timeout)
+            queued.append(entry)
+            self.__lanes[lane] = queued
+            self.__queuedCount += 1
+
+        self.__loop.call_soon_threadsafe(self.__wakeup.set)
+        return handle
+
+    def __shed_job(self, priority: int):
+        retryAfter = max(1, math.ceil(self.__queuedCount * self.__averageExecutionTime / self.__maxConcurrency))
+
+        # Make room by dropping the newest of the least important queued jobs
+        candidates = [j for jobs in self.__lanes.values() for j in jobs if j.priority > priority]
+        if not candidates:
+            self.__stats['rejected'] += 1
+            raise JobQueueFullError('Too many queued requests, try again later', retryAfter)
+
+        victim = max(candidates, key=lambda j: (j.priority, j.sequence))
+        jobs = self.__lanes[victim.lane]
+        jobs.remove(victim)
+        if not jobs:
+            del self.__lanes[victim.lane]
+        self.__queuedCount -= 1
+        self.__stats['rejected'] += 1
+        for handle in victim.handles:
+            self.__resolve(handle.future, exception=JobQueueFullError('Dropped in favor of a more important request, try again later', retryAfter))
+
+    def run_coroutine(self, coro) -> ThreadFuture:
+        """
+        Run a coroutine on the queue loop outside of any lane, e.g. for
+        background services.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats)
+
+    def depth(self) -> int:
+        """
+        Number of jobs waiting to be started.
+        """
+        return self.__queuedCount
+
+    def running_count(self) -> int:
+        return len(self.__runningJobs)
 
-    def submit_job(self, job, *args, **kwargs):
-        future = ThreadFuture()
-        asyncio.run_coroutine_threadsafe(self.__job_queue.put((job, args, kwargs, future)), self.__loop)
-        return asyncio.wrap_future(future)
+def current_deadline() -> float:
+    """
+    Monotonic time by which the job running in the current context has to
+    be done, None if it may take as long as it needs.
+    """
+    return _current_deadline.get()
@@ -0,0 +1,125 @@
+import json
+import logging
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from job_queue import JobHandle
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_DELIVERIES = Counter('nuki_webhook_deliveries_total', 'Completion callbacks of asynchronous jobs', ['result'])
+
+class StoredJob:
+    def __init__(self, handle: JobHandle, info: Dict[str, any], callback_url: str = None, idempotency_key: tuple = None):
+        self.id = uuid.uuid4().hex
+        self.handle = handle
+        self.info = info
+        self.callbackUrl = callback_url
+        self.idempotencyKey = idempotency_key
+        self.createdAt = time.time()
+        self.finishedAt = None
+
+    @property
+    def status(self) -> str:
+        if self.handle.future.done():
+            return 'failed' if self.handle.future.cancelled() or self.handle.future.exception() is not None else 'succeeded'
+        return 'running' if self.handle.started else 'queued'
+
+class JobStore:
+    """
+    Jobs submitted without waiting for them, so their outcome can be
+    polled. Finished jobs are forgotten after `ttl` seconds, and the oldest
+    jobs once there are more than `max_jobs`, so memory stays bounded.
+    `describe(job)` turns a job into the dict that is returned to clients
+    and posted to the callback URL once the job has finished.
+    """
+
+    def __init__(self, describe, max_jobs: int = 1000, ttl: float = 3600, webhook_timeout: float = 10):
+        self.__describe = describe
+        self.__maxJobs = max(1, max_jobs)
+        self.__ttl = ttl
+        self.__webhookTimeout = webhook_timeout
+        self.__jobs: Dict[str, StoredJob] = OrderedDict()
+        # (idempotency key, *scope) -> job ID
+        self.__keys: Dict[tuple, str] = {}
+        self.__lock = threading.Lock()
+        # Callbacks must not block the job queue loop
+        self.__webhookExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='webhook')
+
+    def submit(self, submit, info: Dict[str, any], callback_url: str = None, idempotency_key: str = None, scope: Tuple = ()) -> StoredJob:
+        """
+        Store the job whose handle `submit()` returns. If a job with the same
+        `idempotency_key` and `scope` (e.g. address and action) is still
+        known, that one is returned and nothing is submitted. Both happen
+        under one lock, so concurrent retries submit the command only once.
+        """
+        key = (idempotency_key,) + tuple(scope) if idempotency_key else None
+        with self.__lock:
+            self.__evict()
+            job = self.__jobs.get(self.__keys.get(key)) if key else None
+            if job is not None:
+                return job
+
+            job = StoredJob(submit(), info, callback_url, key)
+            self.__jobs[job.id] = job
+            if key:
+                self.__keys[key] = job.id
+            self.__evict()
+
+        job.handle.future.add_done_callback(lambda future: self.__on_done(job))
+        return job
+
+    def get(self, job_id: str) -> StoredJob:
+        with self.__lock:
+            self.__evict()
+            return self.__jobs.get(job_id)
+
+    def jobs(self) -> List[StoredJob]:
+        with self.__lock:
+            self.__evict()
+            return list(self.__jobs.values())
+
+    def __len__(self) -> int:
+        return len(self.__jobs)
+
+    def shutdown(self):
+        self.__webhookExecutor.shutdown(wait=False)
+
+    def __evict(self):
+        now = time.time()
+        expired = [j for j in self.__jobs.values() if j.finishedAt is not None and now - j.finishedAt > self.__ttl]
+        for job in expired:
+            self.__remove(job)
+
+        while len(self.__jobs) > self.__maxJobs:
+            self.__remove(next(iter(self.__jobs.values())))
+
+    def __remove(self, job: StoredJob):
+        del self.__jobs[job.id]
+        if job.idempotencyKey and self.__keys.get(job.idempotencyKey) == job.id:
+            del self.__keys[job.idempotencyKey]
+
+    def __on_done(self, job: StoredJob):
+        job.finishedAt = time.time()
+        if job.callbackUrl:
+            try:
+                self.__webhookExecutor.submit(self.__post_callback, job)
+            except RuntimeError:
+                # Shutting down
+                WEBHOOK_DELIVERIES.inc(result='failed')
+
+    def __post_callback(self, job: StoredJob):
+        try:
+            body = json.dumps(self.__describe(job)).encode('utf-8')
+            request = urllib.request.Request(job.callbackUrl, data=body, method='POST', headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=self.__webhookTimeout):
+                pass
+            WEBHOOK_DELIVERIES.inc(result='delivered')
+        except Exception as e:
+            WEBHOOK_DELIVERIES.inc(result='failed')
+            logger.warning(f"Could not post result of job {job.id} to {job.callbackUrl}: {e}")
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, List
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+WARM_REQUESTS = Counter('nuki_keep_warm_requests_total', 'Requests that found a warm link to the device or had to connect', ['result'])
+PRECONNECTS = Counter('nuki_keep_warm_preconnects_total', 'Links opened ahead of expected commands')
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+class _DeviceUsage:
+    def __init__(self):
+        self.recent = deque()
+        # Commands per hour of the day, separately for weekdays and weekends
+        self.hourly = [[0] * 24, [0] * 24]
+        # Different days a command came in at each hour, and the last of them
+        self.hourlyDays = [[0] * 24, [0] * 24]
+        self.hourlyLastDay = [[None] * 24, [None] * 24]
+        self.firstSeen = time.time()
+        self.budgetDay = None
+        self.budgetSpent = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.preconnects = 0
+
+class KeepWarmPolicy:
+    """
+    Decides which devices get their link kept open or opened ahead of time:
+    devices in one of the `schedules`, devices used at least `hot_rate`
+    times in the last hour and devices that usually get a command at this
+    time of day, on at least `predict_min_days` different days. Idle time
+    beyond `base_idle_timeout` is charged against a daily `budget` in
+    seconds per device to spare the batteries.
+
+    A schedule is a dict with 'from' and 'to' ('HH:MM') and optionally
+    'address' and 'days' (e.g. ['mon', 'fri']).
+    """
+
+    def __init__(self, addresses, preconnect, is_open, enabled: bool = False, base_idle_timeout: float = 20,
+            idle_timeout: float = 300, hot_rate: float = 4, predict_threshold: float = 0.5, predict_min_days: int = 3, budget: float = 1800,
+            schedules: List[dict] = None, interval: float = 30):
+        self.__addresses = addresses
+        self.__preconnect = preconnect
+        self.__isOpen = is_open
+        self.enabled = enabled
+        self.__baseIdleTimeout = base_idle_timeout
+        self.__idleTimeout = idle_timeout
+        self.__hotRate = hot_rate
+        self.__predictThreshold = predict_threshold
+        self.__predictMinDays = max(1, predict_min_days)
+        self.__budget = budget
+        self.__schedules = schedules or []
+        self.__interval = interval
+        self.__usage: Dict[str, _DeviceUsage] = {}
+        self.__preconnecting = set()
+        self.__task = None
+
+    async def start(self):
+        if self.enabled and self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def record_command(self, address: str):
+        now = time.time()
+        usage = self.__get_usage(address)
+        usage.recent.append(now)
+        self.__expire_recent(usage, now)
+
+        local = time.localtime(now)
+        usage.hourly[local.tm_wday >= 5][local.tm_hour] += 1
+        day = (local.tm_year, local.tm_yday)
+        if usage.hourlyLastDay[local.tm_wday >= 5][local.tm_hour] != day:
+            usage.hourlyLastDay[local.tm_wday >= 5][local.tm_hour] = day
+            usage.hourlyDays[local.tm_wday >= 5][local.tm_hour] += 1
+
+    def idle_timeout(self, address: str, default: float) -> float:
+        """
+        Seconds to keep an idle link to the device open.
+        """
+        if self.enabled and self.budget_left(address) > 0 and self.reason(address) is not None:
+            return max(default, self.__idleTimeout)
+        return default
+
+    def on_connection(self, address: str, warm: bool):
+        usage = self.__get_usage(address)
+        key = address.upper()
+        if key in self.__preconnecting:
+            # Our own warm up, not a request
+            self.__preconnecting.discard(key)
+            return
+
+        if warm:
+            usage.hits += 1
+            WARM_REQUESTS.inc(result='hit')
+        else:
+            usage.misses += 1
+            WARM_REQUESTS.inc(result='miss')
+
+    def preconnect_done(self, address: str):
+        # In case the warm up failed before it got a link
+        self.__preconnecting.discard(address.upper())
+
+    def on_idle_end(self, address: str, idle: float):
+        # Idle time up to the regular timeout would have been spent anyway
+        extra = idle - self.__baseIdleTimeout
+        if extra > 0:
+            usage = self.__get_usage(address)
+            self.__roll_budget(usage)
+            usage.budgetSpent += extra
+
+    def budget_left(self, address: str) -> float:
+        usage = self.__get_usage(address)
+        self.__roll_budget(usage)
+        return max(0.0, self.__budget - usage.budgetSpent)
+
+    def reason(self, address: str) -> str:
+        """
+        Why the device should be warm right now ('schedule', 'hot' or
+        'predicted'), None if it shouldn't.
+        """
+        now = time.time()
+        local = time.localtime(now)
+        if any(self.__schedule_matches(s, address, local) for s in self.__schedules):
+            return 'schedule'
+
+        usage = self.__usage.get(address.upper())
+        if usage is None:
+            return None
+
+        self.__expire_recent(usage, now)
+        if len(usage.recent) >= self.__hotRate:
+            return 'hot'
+
+        # Expected commands in this hour on this kind of day. Only an hour used on several
+        # days is a pattern, a burst of commands within one hour is not.
+        weekend = local.tm_wday >= 5
+        count = usage.hourly[weekend][local.tm_hour]
+        days = max(1.0, (now - usage.firstSeen) / 86400 * (2 / 7 if weekend else 5 / 7))
+        if usage.hourlyDays[weekend][local.tm_hour] >= self.__predictMinDays and count / days >= self.__predictThreshold:
+            return 'predicted'
+
+        return None
+
+    def hit_rate(self) -> float:
+        hits = sum(u.hits for u in self.__usage.values())
+        total = hits + sum(u.misses for u in self.__usage.values())
+        return hits / total if total else 0.0
+
+    def status(self) -> Dict[str, any]:
+        devices = []
+        for address in self.__addresses():
+            usage = self.__get_usage(address)
+            self.__expire_recent(usage, time.time())
+            devices.append({
+                'address': address,
+                'reason': self.reason(address),
+                'isWarm': self.__isOpen(address),
+                'commandsLastHour': len(usage.recent),
+                'budgetLeft': round(self.budget_left(address), 1),
+                'hits': usage.hits,
+                'misses': usage.misses,
+                'preconnects': usage.preconnects,
+            })
+
+        return {'enabled': self.enabled, 'hitRate': round(self.hit_rate(), 3), 'devices': devices}
+
+    async def __run(self):
+        while True:
+            for address in self.__addresses():
+                try:
+                    if self.__isOpen(address) or self.budget_left(address) <= 0:
+                        continue
+
+                    reason = self.reason(address)
+                    if reason is not None:
+                        logger.info(f"Warming up link to {address} ({reason})")
+                        self.__preconnecting.add(address.upper())
+                        self.__get_usage(address).preconnects += 1
+                        PRECONNECTS.inc()
+                        self.__preconnect(address)
+                except Exception as e:
+                    self.__preconnecting.discard(address.upper())
+                    logger.warning(f"Could not warm up link to {address}: {e}")
+
+            await asyncio.sleep(self.__interval)
+
+    def __get_usage(self, address: str) -> _DeviceUsage:
+        return self.__usage.setdefault(address.upper(), _DeviceUsage())
+
+    @staticmethod
+    def __expire_recent(usage: _DeviceUsage, now: float):
+        while usage.recent and now - usage.recent[0] > 3600:
+            usage.recent.popleft()
+
+    @staticmethod
+    def __roll_budget(usage: _DeviceUsage):
+        today = time.localtime().tm_yday
+        if usage.budgetDay != today:
+            usage.budgetDay = today
+            usage.budgetSpent = 0.0
+
+    @staticmethod
+    def __schedule_matches(schedule: dict, address: str, local: time.struct_time) -> bool:
+        if schedule.get('address') and schedule['address'].upper() != address.upper():
+            return False
+
+        days = schedule.get('days')
+        if days and DAY_NAMES[local.tm_wday] not in [d.lower()[:3] for d in days]:
+            return False
+
+        minute = local.tm_hour * 60 + local.tm_min
+        start = _parse_minute(schedule.get('from', '00:00'))
+        end = _parse_minute(schedule.get('to', '24:00'))
+        if start <= end:
+            return start <= minute < end
+        # Spans midnight
+        return minute >= start or minute < end
+
+def _parse_minute(value: str) -> int:
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
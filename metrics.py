@@ -0,0 +1,155 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds, from a cached lookup up to a slow scan
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Registry:
+    def __init__(self):
+        self.__metrics = []
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.samples())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+class _Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self._labelNames = tuple(labels)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, any]) -> Tuple:
+        return tuple(labels.get(n, '') for n in self._labelNames)
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self.__values.items())
+        return [f"{self.name}{_format_labels(self._labelNames, k)} {_format_value(v)}" for k, v in values]
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__values: Dict[Tuple, float] = {}
+        self.__function = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.__values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """
+        Read the value from `function()` whenever the metrics are collected.
+        """
+        self.__function = function
+
+    def samples(self) -> List[str]:
+        if self.__function is not None:
+            return [f"{self.name} {_format_value(self.__function())}"]
+
+        with self._lock:
+            values = list(self.__values.items())
+        return [f"{self.name}{_format_labels(self._labelNames, k)} {_format_value(v)}" for k, v in values]
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__buckets = tuple(sorted(buckets))
+        # Per label set: counts per bucket (the last one is +Inf), sum
+        self.__values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.__buckets, value)
+        with self._lock:
+            entry = self.__values.get(key)
+            if entry is None:
+                entry = self.__values[key] = ([0] * (len(self.__buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the `with` block, also when it fails.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(counts), total[0]) for k, (counts, total) in self.__values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self._labelNames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self._labelNames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self._labelNames, key)} {cumulative}")
+
+        return lines
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import logging
+import math
+import random
+import time
+from typing import Dict
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+BLE_RETRIES = Counter('nuki_ble_retries_total', 'BLE operations that were tried again after a transient error', ['operation'])
+CIRCUIT_REJECTIONS = Counter('nuki_circuit_breaker_rejections_total', 'Operations refused because the device is considered out of reach')
+CIRCUIT_TRANSITIONS = Counter('nuki_circuit_breaker_transitions_total', 'State changes of the per device circuit breakers', ['state'])
+
+# Errors a Nuki reports that are worth another try, everything else (e.g. a bad
+# authorization or a blocked motor) won't go away by repeating the command
+TRANSIENT_NUKI_ERRORS = ('ERROR_BAD_CRC', 'ERROR_BAD_LENGTH', 'K_ERROR_BAD_NONCE', 'K_ERROR_BUSY')
+
+class CircuitOpenError(ConnectionError):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_transient(e: BaseException) -> bool:
+    """
+    Whether the operation that raised `e` might succeed if it is repeated.
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+    if type(e).__name__ == 'NukiErrorException':
+        return str(getattr(e, 'error_code', '')) in TRANSIENT_NUKI_ERRORS
+    # BleakError is matched by name so that bleak doesn't have to be imported
+    if isinstance(e, (ConnectionError, TimeoutError, asyncio.TimeoutError, EOFError, OSError)):
+        return True
+    return any(c.__name__ == 'BleakError' for c in type(e).__mro__)
+
+class _Circuit:
+    def __init__(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt = 0.0
+        self.resetTimeout = 0.0
+        # Whether the single operation let through while half open is running
+        self.probing = False
+
+class CircuitBreaker:
+    """
+    Fails fast for devices that are out of reach. After `failure_threshold`
+    operations in a row have failed with transient errors, the circuit of
+    the device opens and operations are refused for `reset_timeout`
+    seconds. Then a single operation may try again (half open) while all
+    others are still refused, if it fails too the wait doubles up to
+    `max_reset_timeout`. An advertisement of the device shows it is back in
+    range and lets the next operation try right away.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30, max_reset_timeout: float = 600):
+        self.__failureThreshold = max(1, failure_threshold)
+        self.__resetTimeout = reset_timeout
+        self.__maxResetTimeout = max(reset_timeout, max_reset_timeout)
+        self.__circuits: Dict[str, _Circuit] = {}
+
+    def check(self, address: str):
+        """
+        Raise CircuitOpenError if operations for the device are refused right
+        now, without claiming the single attempt of a half open circuit.
+        """
+        circuit = self.__circuits.get(address.upper()) if address else None
+        if circuit is not None:
+            self.__refuse(address, circuit)
+
+    def admit(self, address: str) -> bool:
+        """
+        Like check(), but an operation let through while the circuit is half
+        open becomes its probe and others are refused until it reports back
+        through on_success() or on_failure(). Returns whether it is the probe.
+        """
+        circuit = self.__circuits.get(address.upper()) if address else None
+        if circuit is None or circuit.state == self.CLOSED:
+            return False
+
+        self.__refuse(address, circuit)
+        if circuit.state == self.OPEN:
+            self.__transition(circuit, self.HALF_OPEN)
+        circuit.probing = True
+        return True
+
+    def __refuse(self, address: str, circuit: _Circuit):
+        if circuit.state == self.OPEN:
+            remaining = circuit.openedAt + circuit.resetTimeout - time.monotonic()
+            if remaining > 0:
+                CIRCUIT_REJECTIONS.inc()
+                raise CircuitOpenError(f"Device {address} is not reachable, not trying again for {math.ceil(remaining)} seconds",
+                    max(1, math.ceil(remaining)))
+        elif circuit.state == self.HALF_OPEN and circuit.probing:
+            CIRCUIT_REJECTIONS.inc()
+            raise CircuitOpenError(f"Device {address} is not reachable, another command is trying again", 1)
+
+    def on_success(self, address: str):
+        circuit = self.__circuits.get(address.upper())
+        if circuit is not None:
+            circuit.probing = False
+            if circuit.state != self.CLOSED:
+                logger.info(f"Device {address} is reachable again")
+                self.__transition(circuit, self.CLOSED)
+            circuit.failures = 0
+            circuit.resetTimeout = 0.0
+
+    def on_failure(self, address: str, e: BaseException):
+        circuit = self.__circuits.get(address.upper())
+        if circuit is not None:
+            circuit.probing = False
+        if not is_transient(e):
+            # The device answered, it's just not happy with the request
+            return
+
+        circuit = self.__circuits.setdefault(address.upper(), _Circuit())
+        circuit.failures += 1
+        if circuit.state == self.HALF_OPEN or circuit.failures >= self.__failureThreshold:
+            circuit.resetTimeout = min(self.__maxResetTimeout, circuit.resetTimeout * 2 or self.__resetTimeout)
+            circuit.openedAt = time.monotonic()
+            if circuit.state != self.OPEN:
+                logger.warning(f"Device {address} failed {circuit.failures} times, failing fast for {circuit.resetTimeout:.0f} seconds")
+                self.__transition(circuit, self.OPEN)
+
+    def on_advertisement(self, device, advertisement_data):
+        circuit = self.__circuits.get(device.address.upper())
+        if circuit is not None and circuit.state == self.OPEN:
+            self.__transition(circuit, self.HALF_OPEN)
+
+    def state(self, address: str) -> str:
+        circuit = self.__circuits.get(address.upper()) if address else None
+        return circuit.state if circuit is not None else self.CLOSED
+
+    def open_count(self) -> int:
+        return sum(1 for c in self.__circuits.values() if c.state == self.OPEN)
+
+    @staticmethod
+    def __transition(circuit: _Circuit, state: str):
+        circuit.state = state
+        CIRCUIT_TRANSITIONS.inc(state=state)
+
+class RetryPolicy:
+    """
+    Repeats BLE operations that failed with a transient error up to
+    `attempts` times in total, waiting a random time of up to `base_delay`
+    doubled with every attempt (at most `max_delay`) in between. Failures
+    and successes are reported to the circuit breaker.
+
+    `deadline()` returns the monotonic time by which the current operation
+    has to be done, or None. No attempt is started that can't finish by
+    then, and an operation cancelled at the deadline counts as a failure.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 5, deadline=None):
+        self.breaker = breaker
+        self.__attempts = max(1, attempts)
+        self.__baseDelay = base_delay
+        self.__maxDelay = max_delay
+        self.__deadline = deadline or (lambda: None)
+
+    async def call(self, address: str, operation: str, function, retry: bool = True):
+        """
+        Await `function()`. Operations that must not be executed twice, like
+        unlatching, pass `retry` False.
+        """
+        attempts = self.__attempts if retry else 1
+        for attempt in range(attempts):
+            probe = self.breaker.admit(address)
+            started = time.monotonic()
+            try:
+                result = await function()
+            except asyncio.CancelledError as e:
+                # Given up at the deadline the device didn't answer in time, other
+                # cancellations, e.g. while shutting down, say nothing about it
+                remaining = self.__remaining()
+                expired = remaining is not None and remaining <= 0
+                self.breaker.on_failure(address, TimeoutError(f"{operation} on {address} did not finish in time") if expired else e)
+                raise
+            except Exception as e:
+                # A failed probe reopens the circuit right away
+                delay = self.delay(attempt)
+                remaining = self.__remaining()
+                if probe or attempt + 1 >= attempts or not is_transient(e) or \
+                        (remaining is not None and remaining < delay + time.monotonic() - started):
+                    self.breaker.on_failure(address, e)
+                    raise
+
+                logger.warning(f"{operation} on {address} failed, retrying in {delay:.2f} seconds: {e}")
+                BLE_RETRIES.inc(operation=operation)
+                await asyncio.sleep(delay)
+                continue
+
+            self.breaker.on_success(address)
+            return result
+
+    def __remaining(self) -> float:
+        deadline = self.__deadline()
+        return deadline - time.monotonic() if deadline is not None else None
+
+    @contextlib.asynccontextmanager
+    async def connection(self, address: str, connect):
+        """
+        Enter the context manager returned by `connect()`, retrying to set
+        up the link.
+        """
+        stack = contextlib.AsyncExitStack()
+        device = await self.call(address, 'connect', lambda: stack.enter_async_context(connect()))
+        async with stack:
+            yield device
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter, so that retries of several requests don't line up
+        return random.uniform(0, min(self.__maxDelay, self.__baseDelay * 2 ** attempt))
@@ -1,19 +1,47 @@
-from flask import Flask, request, jsonify
-from flasgger import Swagger
+from __future__ import annotations
+from startup import LazyModule, StartupTimer, preload
+
+# Started before the other imports so that they are part of the breakdown
+startup_timer = StartupTimer()
+
+from flask import Flask, Response, request, jsonify
 import json
 import base64
+import hashlib
 import os
-import pyNukiBT
 import random
 import threading
 import logging
 import asyncio
-from typing import List, Dict, Tuple
-from bleak import BleakScanner
-from bleak import BleakClient
-from bleak.backends.device import BLEDevice
-from nacl.public import PrivateKey
-from job_queue import JobQueue
+import signal
+import socket
+import time
+from concurrent.futures import Future as ThreadFuture
+from typing import TYPE_CHECKING, List, Dict, Tuple
+from job_queue import JobQueue, JobHandle, JobQueueFullError, JobSupersededError, JobCancelledError, current_deadline
+from job_store import JobStore, StoredJob
+from connection_manager import ConnectionManager
+from device_scanner import DeviceScanner
+from state_cache import StateCache
+from state_monitor import StateMonitor, Subscription
+from device_registry import DeviceRegistry
+from device_cache import DeviceHandleCache
+from adapters import AdapterSelector, MultiAdapterScanner, MultiAdapterConnectionManager
+from keep_warm import KeepWarmPolicy
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from connection_manager import BLE_OPERATION_SECONDS
+from metrics import Gauge, Histogram, render as render_metrics
+import tracing
+import cluster as cluster_module
+
+if TYPE_CHECKING:
+    from bleak.backends.device import BLEDevice
+
+# Heavy and only needed once a device is talked to, see preload() in start_services()
+pyNukiBT = LazyModule('pyNukiBT')
+state_schema = LazyModule('state_schema')
+
+startup_timer.record('imports', startup_timer.elapsed())
 
 swagger_config = {
     "headers": [],
@@ -32,21 +60,55 @@ swagger_config = {
     "description": "This is the description of nukiRestful, a REST API to control Nuki locks via Bluetooth Low-Energy BLE. It is powered by Flask, pyNukiBT, bleak and Flasgger",
 }
 
-# Flask & Swaggedr
+# Flask & Swagger, the latter is set up by init_api_docs() when run as a server
 app = Flask(__name__)
-swagger = Swagger(app, config=swagger_config, merge=True)
+swagger = None
 
 # Config
 config = {}
 configPath = "./settings/config.json"
+registry = DeviceRegistry(config, lambda config: save_config(configPath, config))
 
 # Logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 # Other globals
-scanner = BleakScanner()
+scanner = DeviceScanner()
+state_cache = StateCache()
+device_handles = DeviceHandleCache(lambda address: create_nuki_device(address, config))
 job_queue = JobQueue()
+connection_manager = ConnectionManager(lambda address: async_create_device(address))
+# None uses pyNukiBT.NukiDevice
+device_class = None
+adapter_selector = AdapterSelector([None], lambda address: None)
+keep_warm = KeepWarmPolicy(lambda: [], lambda address: None, lambda address: False)
+# None unless the node is part of a cluster
+cluster = None
+job_store = JobStore(lambda job: describe_job(job))
+retry_policy = RetryPolicy(CircuitBreaker())
+state_monitor = StateMonitor(lambda address: registry.get(address) is not None, lambda address: refresh_device_state(address))
+
+# Metrics
+CONFIG_SAVE_SECONDS = Histogram('nuki_config_save_seconds', 'Time spent writing the settings file')
+Gauge('nuki_job_queue_depth', 'Jobs waiting to be started').set_function(lambda: job_queue.depth())
+Gauge('nuki_job_queue_running', 'Jobs being executed').set_function(lambda: job_queue.running_count())
+Gauge('nuki_event_subscribers', 'Clients following /events').set_function(lambda: state_monitor.subscriber_count())
+Gauge('nuki_keep_warm_hit_ratio', 'Share of requests that found a warm link').set_function(lambda: keep_warm.hit_rate())
+Gauge('nuki_circuit_breaker_open', 'Devices currently failing fast').set_function(lambda: retry_policy.breaker.open_count())
+
+# Commands accepted by /batch
+BATCH_ACTIONS = ('lock', 'unlock', 'unlatch', 'state')
+
+# Seconds after which an idle event stream sends a keepalive comment
+EVENT_KEEPALIVE_INTERVAL = 15
+
+# Nuki's OUI, 52:D2:72 was matched before and is kept for compatibility
+NUKI_ADDRESS_PREFIXES = ('54:D2:72:', '52:D2:72:')
+SCAN_MAX_DURATION = 60
+# Devices buffered per /scan stream and seconds between checks whether the scan has ended
+SCAN_STREAM_BUFFER = 1000
+SCAN_STREAM_POLL_INTERVAL = 0.2
 
 @app.get('/listPaired')
 async def listPaired():
@@ -55,6 +117,17 @@ async def listPaired():
     ---
     tags:
         - Pairing
+    parameters:
+    - name: refresh
+      in: query
+      type: boolean
+      required: false
+      description: Connect to the devices to update their info (default). With false the stored info is returned right away.
+    - name: timeout
+      in: query
+      type: number
+      required: false
+      description: Time in seconds each device may take to update its info, not counting the time it waits for the others. Defaults to listPairedTimeout from the settings.
     responses:
         200:
             description: Successfully listed and updated paired devices
@@ -75,48 +148,100 @@ async def listPaired():
                                 isReachable:
                                     type: boolean
                                     description: Whether the device is reachable
+                                timedOut:
+                                    type: boolean
+                                    description: Whether updating the device info took too long
+                                error:
+                                    type: string
+                                    description: Error while updating the device info
                                 name:
                                     type: string
                                     description: Name of the device
                                 id:
                                     type: string
                                     description: ID of the device
+                                adapter:
+                                    type: string
+                                    description: Bluetooth adapter the device is assigned to
+                                rssi:
+                                    type: object
+                                    description: Recent signal strength of the device per adapter that receives it
+                                circuit:
+                                    type: string
+                                    description: closed if the device is used normally, open while it is considered out of reach and commands fail fast, half-open while a single command tries again and the others still fail fast
+        503:
+            description: Too many queued requests, retry after the time given in the Retry-After header
         500:
             description: Error while listing paired devices
     """
 
     try:
-        devices = await job_queue.submit_job(async_get_registered_devices, config=config)
-            
+        refresh: bool = request.args.get('refresh', default='true').lower() != 'false'
+        timeout: float = request.args.get('timeout', default=config['listPairedTimeout'], type=float)
+
+        if refresh:
+            devices = await async_get_registered_devices(config, timeout)
+        else:
+            devices = [{
+                    'address': pairedDevice['address'],
+                    'isReachable': scanner.get_device(pairedDevice['address']) != None,
+                    'name': pairedDevice.get('name'),
+                    'id': pairedDevice.get('id'),
+                    **adapter_info(pairedDevice['address'])
+                } for pairedDevice in registry.entries()]
+
         return jsonify({
             'message': f'Found {len(devices)} registered devices',
             'devices': devices
         }), 200
+    except JobQueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-async def async_get_registered_devices(config: Dict[str, any]):
-    devices = []
-    for pairedDevice in config['pairedDevices']:
+async def async_get_registered_devices(config: Dict[str, any], timeout: float):
+    async def refresh(pairedDevice: Dict[str, any]):
         address = pairedDevice['address']
-        _, device, ble_device = await async_get_paired_device( address, config )
-
-            # Update name and id if possible
-        if ble_device != None:
-            logger.info(f"Updating info of device {address}...")
-            await device.connect()
-            await device.update_state()
-            update_and_save_device_info(device, address, config)
-            await device.disconnect()
-
-        devices.append({
-                'address': address,
-                'isReachable': ble_device != None,
-                'name': pairedDevice['name'],
-                'id': pairedDevice['id']
-            })
-        
-    return devices
+        result = {'address': address, 'isReachable': False, 'timedOut': False}
+
+        # Update name and id if possible, each device in its own lane. Devices queued behind
+        # the others get the same time once they are started.
+        try:
+            await job_queue.submit_job(async_update_device_info, address=address, config=config,
+                lane=device_lane(address), priority=JobQueue.PRIORITY_MAINTENANCE, run_timeout=timeout, coalesce_key='info')
+            result['isReachable'] = True
+        except JobQueueFullError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"Updating info of device {address} timed out")
+            result['timedOut'] = True
+        except ConnectionError:
+            pass
+        except Exception as e:
+            result['error'] = str(e)
+
+        result['name'] = pairedDevice.get('name')
+        result['id'] = pairedDevice.get('id')
+        result.update(adapter_info(address))
+
+        return result
+
+    # Changed infos are written in one go by the registry
+    return await asyncio.gather(*[refresh(pairedDevice) for pairedDevice in registry.entries()])
+
+def adapter_info(address: str) -> Dict[str, any]:
+    return {
+        'adapter': adapter_selector.preferred(address) or 'default',
+        'rssi': {(adapter or 'default'): rssi for adapter, rssi in adapter_selector.rssi(address).items()},
+        'circuit': retry_policy.breaker.state(address)
+    }
+
+async def async_update_device_info(address: str, config: Dict[str, any]):
+    logger.info(f"Updating info of device {address}...")
+    async with retry_policy.connection(address, lambda: connection_manager.connection(address)) as device:
+        with tracing.span('update_state', address=address):
+            await retry_policy.call(address, 'update_state', device.update_state)
+        update_and_save_device_info(device, address)
 
 @app.post('/pair')
 async def pair():
@@ -142,6 +267,8 @@ async def pair():
             description: Device registered successfully
         400:
             description: MAC address is missing
+        503:
+            description: Too many queued requests, retry after the time given in the Retry-After header
         500:
             description: Error while pairing with the device
     """
@@ -160,46 +287,64 @@ async def pair():
         # Perform your logic here with the MAC address
         logger.info(f"Received MAC address: {address}")
         
-        ble_device = await job_queue.submit_job(scanner.find_device_by_address, device_identifier=address)
-        #ble_device = await scanner.find_device_by_address(device_identifier=address)
-
-        if ble_device == None:
-            raise ConnectionError(f"Device with address {address} is not reachable.")
-
-        # Try to register device, get auth info and save to config
-        client_type = pyNukiBT.NukiConst.NukiClientType.BRIDGE
-        
-        device = pyNukiBT.NukiDevice(address=address, auth_id=None, nuki_public_key=None,
-            bridge_public_key=base64.b64decode(config['publicKey']), 
-            bridge_private_key=base64.b64decode(config['privateKey']),
-            app_id=config['appId'], name=config['appName'], client_type=client_type, ble_device=ble_device, 
-            get_ble_device=lambda addr: scanner.find_device_by_address(address))
-        
-        await job_queue.submit_job( device.connect )
-
-        pairingResult = await job_queue.submit_job( device.pair )
-
-        config['pairedDevices'] = replace_or_add_entry_by_address(
-            config['pairedDevices'], 
-            {
-                'address': address,
-                'authId': pairingResult['auth_id'],
-                'devicePublicKey': pairingResult['nuki_public_key'],
-            }
-        )
-        
-        save_config(configPath, config)
-
-        await job_queue.submit_job( device.disconnect )
+        # Pairing needs the radio for itself
+        await job_queue.submit_job( async_pair_device, address=address, config=config, lane=JobQueue.EXCLUSIVE,
+            priority=JobQueue.PRIORITY_MAINTENANCE )
     
         # Return a success response
         return jsonify({'message': 'Device registered successfully'}), 200
     
     except pyNukiBT.NukiErrorException as nex:
         return jsonify({'error': 'Error while pairing with Nuki device. Make sure the device is in pairing mode (press the button for 6 seconds) and that the address is correct.'}), 500
+    except JobQueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+async def async_pair_device(address: str, config: Dict[str, any]):
+    # Drop the link and device handle that might still use the keys of a previous pairing
+    await connection_manager.close(address)
+    device_handles.invalidate(address)
+
+    with tracing.span('find_device_by_address', address=address):
+        ble_device = await scanner.find_device_by_address(device_identifier=address)
+
+    if ble_device == None:
+        raise ConnectionError(f"Device with address {address} is not reachable.")
+
+    # Try to register device, get auth info and save to config
+    client_type = pyNukiBT.NukiConst.NukiClientType.BRIDGE
+    
+    device = nuki_device_class()(address=address, auth_id=None, nuki_public_key=None,
+        bridge_public_key=base64.b64decode(config['publicKey']), 
+        bridge_private_key=base64.b64decode(config['privateKey']),
+        app_id=config['appId'], name=config['appName'], client_type=client_type, ble_device=ble_device, 
+        get_ble_device=lambda addr: scanner.get_device(address))
+    
+    with tracing.span('connect', address=address):
+        await device.connect()
+
+    with tracing.span('pair', address=address):
+        pairingResult = await device.pair()
+
+    pairedDevice = {
+        'address': address,
+        'authId': pairingResult['auth_id'],
+        'devicePublicKey': pairingResult['nuki_public_key'],
+    }
+
+    # Keep the adapter the device has been pinned to
+    previous = registry.get(address)
+    if previous and previous.get('adapter'):
+        pairedDevice['adapter'] = previous['adapter']
+
+    registry.add_or_replace(pairedDevice)
+
+    # Don't risk losing fresh keys, without blocking the loop on the write
+    await asyncio.to_thread(registry.flush)
+
+    await device.disconnect()
+
 @app.post('/unpair')
 async def unpair():
     """
@@ -224,6 +369,8 @@ async def unpair():
         description: Device unpaired successfully
       400:
         description: MAC address is missing or device not paired
+      503:
+          description: Too many queued requests, retry after the time given in the Retry-After header
       500:
         description: Error while unpairing the device
     """
@@ -234,17 +381,18 @@ async def unpair():
         if not address:
             return jsonify({'error': 'MAC address is missing'}), 400
         
-        paired_devices = [device for device in config['pairedDevices'] if device.get('address') == address]
-        
-        if not paired_devices:
+        if not registry.remove(address):
             return jsonify({'error': f'Device with address {address} is not paired'}), 400
 
-        config['pairedDevices'] = [device for device in config['pairedDevices'] if device.get('address') != address]
+        # In asgi mode the loop is shared with every other request
+        await asyncio.to_thread(registry.flush)
 
-        save_config(configPath, config)
+        await job_queue.submit_job( async_forget_device, address, lane=device_lane(address), priority=JobQueue.PRIORITY_MAINTENANCE )
         
         return jsonify({'message': 'Device unpaired successfully'}), 200
     
+    except JobQueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -255,6 +403,29 @@ async def scan():
     ---
     tags:
         - Pairing
+    parameters:
+    - name: duration
+      in: query
+      type: number
+      required: false
+      description: >
+          Seconds to look for devices, at most 60. Defaults to 5. Answered right away from the background scanner
+          if it has been running for that long. 0 returns the devices seen within scanCacheMaxAge.
+    - name: minRssi
+      in: query
+      type: integer
+      required: false
+      description: Only return devices received at least this strong (dBm), e.g. -80
+    - name: onlyUnpaired
+      in: query
+      type: boolean
+      required: false
+      description: Only return devices that have not been paired yet
+    - name: stream
+      in: query
+      type: boolean
+      required: false
+      description: Stream the devices as newline delimited JSON (application/x-ndjson) as soon as they are found
     responses:
         200:
             description: Successfully scanned and found possible Nuki devices
@@ -275,25 +446,107 @@ async def scan():
                                 address:
                                     type: string
                                     description: MAC address of the device
+                                rssi:
+                                    type: integer
+                                    description: Signal strength of the latest advertisement in dBm
+                                lastSeen:
+                                    type: string
+                                    description: Time of the latest advertisement
+                                paired:
+                                    type: boolean
+                                    description: Whether the device has been paired already
+        400:
+            description: One of the parameters is out of range
         500:
             description: Error while scanning for devices
     """
+    try:
+        duration: float = request.args.get('duration', default=5.0, type=float)
+        minRssi: int = request.args.get('minRssi', default=None, type=int)
+        onlyUnpaired: bool = request.args.get('onlyUnpaired', default=False, type=query_flag)
+        if not 0 <= duration <= SCAN_MAX_DURATION:
+            raise ValueError(f'duration has to be between 0 and {SCAN_MAX_DURATION} seconds')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    match = lambda entry: scan_result(entry, minRssi, onlyUnpaired)
+    if request.args.get('stream', default=False, type=query_flag):
+        # Devices are sent as the scanner reports them, while the scan is still running
+        if config['serverMode'] == 'asgi':
+            subscription = Subscription(None, SCAN_STREAM_BUFFER, loop=asyncio.get_running_loop())
+            stream = async_scan_stream(subscription, job_queue.run_coroutine(async_scan(duration, match, subscription)))
+        else:
+            subscription = Subscription(None, SCAN_STREAM_BUFFER)
+            stream = scan_stream(subscription, job_queue.run_coroutine(async_scan(duration, match, subscription)))
+        return Response(stream, mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     try:
-        
-        await job_queue.submit_job( scanner.stop )
-        devices = await job_queue.submit_job( scanner.discover )
-        deviceCandidates = []
-        for device in devices:
-            if (device.name and device.name.startswith("Nuki")) or (device.address and device.address.upper().startswith('52:D2:72:')):
-                logger.info(f"Found possible Nuki device {device.name}, Address: {device.address}, RSSI: {device.rssi}")
-                deviceCandidates.append(device)
-        return jsonify({'message': f"Found {len(deviceCandidates)} possible Nuki devices", 
-                        'devices': list(map(lambda x: { 'name': x.name, 'address': x.address },deviceCandidates))}
-        ), 200
+        # Runs on the scanner loop without taking a slot of the job queue, concurrent scans share the radio
+        devices = await asyncio.wrap_future(job_queue.run_coroutine(async_scan(duration, match)))
+        return jsonify({'message': f"Found {len(devices)} possible Nuki devices", 'devices': devices}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def is_nuki_device(device: BLEDevice) -> bool:
+    return bool((device.name and device.name.startswith('Nuki')) or (device.address and device.address.upper().startswith(NUKI_ADDRESS_PREFIXES)))
+
+def scan_result(entry, min_rssi: int = None, only_unpaired: bool = False) -> Dict[str, any]:
+    """
+    The entry as returned by /scan, None if it doesn't pass the filters.
+    """
+    device = entry.device
+    if not is_nuki_device(device) or (min_rssi is not None and (entry.rssi is None or entry.rssi < min_rssi)):
+        return None
+
+    paired = registry.get(device.address) is not None
+    if only_unpaired and paired:
+        return None
+
+    return {'name': device.name, 'address': device.address, 'rssi': entry.rssi, 'lastSeen': format_timestamp(time.time() - entry.age),
+        'paired': paired}
+
+async def async_scan(duration: float, match, subscription: Subscription = None) -> List[Dict[str, any]]:
+    def on_found(entry):
+        result = match(entry)
+        if result is not None:
+            subscription.push(result)
+
+    entries = await scanner.discover(duration, on_found if subscription is not None else None)
+    devices = [d for d in map(match, entries) if d is not None]
+    for device in devices:
+        logger.info(f"Found possible Nuki device {device['name']}, Address: {device['address']}, RSSI: {device['rssi']}")
+    return devices
+
+def format_scan_results(devices: List[dict], error: BaseException = None) -> str:
+    lines = [json.dumps(d) + '\n' for d in devices]
+    if error is not None:
+        lines.append(json.dumps({'error': str(error)}) + '\n')
+    return ''.join(lines)
+
+def scan_error(scan: ThreadFuture) -> BaseException:
+    return None if scan.cancelled() else scan.exception()
+
+def scan_stream(subscription: Subscription, scan: ThreadFuture):
+    try:
+        while not scan.done():
+            devices, _ = subscription.get(SCAN_STREAM_POLL_INTERVAL)
+            if devices:
+                yield format_scan_results(devices)
+        # Whatever was found right before the scan ended
+        yield format_scan_results(subscription.get(0)[0], scan_error(scan))
+    finally:
+        scan.cancel()
+
+async def async_scan_stream(subscription: Subscription, scan: ThreadFuture):
+    try:
+        while not scan.done():
+            devices, _ = await subscription.async_get(SCAN_STREAM_POLL_INTERVAL)
+            if devices:
+                yield format_scan_results(devices)
+        yield format_scan_results((await subscription.async_get(0))[0], scan_error(scan))
+    finally:
+        scan.cancel()
+
 @app.post('/lock')
 async def lock():
     """
@@ -313,30 +566,74 @@ async def lock():
           address:
               type: string
               description: The MAC address
+          supersede:
+              type: boolean
+              description: Drop queued commands of this device that have not been executed yet
+          timeout:
+              type: number
+              description: Seconds to wait for the command including the time it is queued
+          async:
+              type: boolean
+              description: Return right away with a job ID instead of waiting for the command
+          callbackUrl:
+              type: string
+              description: URL the job status is posted to once an asynchronous command has finished
     responses:
         200:
             description: Locked successfully
+        202:
+            description: >
+                Command has been queued (async). The job can be polled at the URL in the Location header.
+                Repeating the request with the same Idempotency-Key header returns the same job.
         400:
             description: MAC address is missing or device not paired
+        409:
+            description: Command has been superseded by a later one
+        503:
+            description: Too many queued requests or the device is out of reach, retry after the time given in the Retry-After header
+        502:
+            description: The node of the cluster handling the device failed to answer, the command may have been executed
+        504:
+            description: Device or the node of the cluster handling it did not respond in time
         500:
             description: Error while locking the device
     """
 
     try:
         # Get JSON data from the request
-        address: str = request.get_json()['address']
-        
-        pairedDevice, device, ble_device = await job_queue.submit_job( async_get_paired_device, address=address, config=config)
+        data = request.get_json()
+        address: str = data['address']
+        supersede: bool = data.get('supersede', False)
+        timeout: float = float(data.get('timeout', config['requestTimeout']))
 
-        if ble_device == None:
-            raise ConnectionError(f"Device with address {address} is not reachable.")
-        
-        await job_queue.submit_job( device.connect )
-        await job_queue.submit_job( device.update_state )
-        await job_queue.submit_job( device.lock )
-        await job_queue.submit_job( device.disconnect )
+        if not address:
+            return jsonify({'error': 'MAC address is missing'}), 400
+
+        # Another node of the cluster might receive the device better
+        forwarded = await forward_to_owner(address)
+        if forwarded is not None:
+            return forwarded
+
+        # Don't queue commands for a device that is known to be out of reach
+        retry_policy.breaker.check(address)
 
-        return jsonify({'message': 'Locked successfully'}), 200
+        if is_async_request(data):
+            return submit_async_command(data, 'lock', supersede)
+
+        # Identical commands in a row are executed once
+        job = job_queue.submit_job( async_execute_lock_action, address=address, config=config, action='lock', lane=device_lane(address),
+            priority=JobQueue.PRIORITY_ACTUATION, timeout=timeout, coalesce_key='lock', supersede_group='action' if supersede else None )
+        await job
+
+        return jsonify({'message': 'Locked successfully', 'coalesced': job.coalesced, 'timing': job_timing(job)}), 200
+    except asyncio.TimeoutError:
+        return jsonify({'error': f'Device did not respond within {timeout} seconds'}), 504
+    except JobSupersededError as e:
+        return jsonify({'error': str(e)}), 409
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -359,30 +656,74 @@ async def unlock():
           address:
               type: string
               description: The MAC address
+          supersede:
+              type: boolean
+              description: Drop queued commands of this device that have not been executed yet
+          timeout:
+              type: number
+              description: Seconds to wait for the command including the time it is queued
+          async:
+              type: boolean
+              description: Return right away with a job ID instead of waiting for the command
+          callbackUrl:
+              type: string
+              description: URL the job status is posted to once an asynchronous command has finished
     responses:
         200:
             description: Unlocked successfully
+        202:
+            description: >
+                Command has been queued (async). The job can be polled at the URL in the Location header.
+                Repeating the request with the same Idempotency-Key header returns the same job.
         400:
             description: MAC address is missing or device not paired
+        409:
+            description: Command has been superseded by a later one
+        503:
+            description: Too many queued requests or the device is out of reach, retry after the time given in the Retry-After header
+        502:
+            description: The node of the cluster handling the device failed to answer, the command may have been executed
+        504:
+            description: Device or the node of the cluster handling it did not respond in time
         500:
             description: Error while unlocking the device
     """
 
     try:
         # Get JSON data from the request
-        address: str = request.get_json()['address']
-        
-        pairedDevice, device, ble_device = await job_queue.submit_job( async_get_paired_device, address=address, config=config)
-        
-        if ble_device == None:
-            raise ConnectionError(f"Device with address {address} is not reachable.")
+        data = request.get_json()
+        address: str = data['address']
+        supersede: bool = data.get('supersede', False)
+        timeout: float = float(data.get('timeout', config['requestTimeout']))
+
+        if not address:
+            return jsonify({'error': 'MAC address is missing'}), 400
+
+        # Another node of the cluster might receive the device better
+        forwarded = await forward_to_owner(address)
+        if forwarded is not None:
+            return forwarded
+
+        # Don't queue commands for a device that is known to be out of reach
+        retry_policy.breaker.check(address)
 
-        await job_queue.submit_job( device.connect )
-        await job_queue.submit_job( device.update_state )
-        await job_queue.submit_job( device.unlock )
-        await job_queue.submit_job( device.disconnect )
+        if is_async_request(data):
+            return submit_async_command(data, 'unlock', supersede)
 
-        return jsonify({'message': 'Unlocked successfully'}), 200
+        # Identical commands in a row are executed once
+        job = job_queue.submit_job( async_execute_lock_action, address=address, config=config, action='unlock', lane=device_lane(address),
+            priority=JobQueue.PRIORITY_ACTUATION, timeout=timeout, coalesce_key='unlock', supersede_group='action' if supersede else None )
+        await job
+
+        return jsonify({'message': 'Unlocked successfully', 'coalesced': job.coalesced, 'timing': job_timing(job)}), 200
+    except asyncio.TimeoutError:
+        return jsonify({'error': f'Device did not respond within {timeout} seconds'}), 504
+    except JobSupersededError as e:
+        return jsonify({'error': str(e)}), 409
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -405,30 +746,74 @@ async def unlatch():
               address:
                   type: string
                   description: The MAC address
+              supersede:
+                  type: boolean
+                  description: Drop queued commands of this device that have not been executed yet
+              timeout:
+                  type: number
+                  description: Seconds to wait for the command including the time it is queued
+              async:
+                  type: boolean
+                  description: Return right away with a job ID instead of waiting for the command
+              callbackUrl:
+                  type: string
+                  description: URL the job status is posted to once an asynchronous command has finished
     responses:
         200:
             description: Unlatched successfully
+        202:
+            description: >
+                Command has been queued (async). The job can be polled at the URL in the Location header.
+                Repeating the request with the same Idempotency-Key header returns the same job.
         400:
             description: MAC address is missing or device not paired
+        409:
+            description: Command has been superseded by a later one
+        503:
+            description: Too many queued requests or the device is out of reach, retry after the time given in the Retry-After header
+        502:
+            description: The node of the cluster handling the device failed to answer, the command may have been executed
+        504:
+            description: Device or the node of the cluster handling it did not respond in time
         500:
             description: Error while unlatching the device
     """
 
     try:
         # Get JSON data from the request
-        address: str = request.get_json()['address']
-        
-        pairedDevice, device, ble_device = await job_queue.submit_job( async_get_paired_device, address=address, config=config)
-        
-        if ble_device == None:
-            raise ConnectionError(f"Device with address {address} is not reachable.")
+        data = request.get_json()
+        address: str = data['address']
+        supersede: bool = data.get('supersede', False)
+        timeout: float = float(data.get('timeout', config['requestTimeout']))
+
+        if not address:
+            return jsonify({'error': 'MAC address is missing'}), 400
+
+        # Another node of the cluster might receive the device better
+        forwarded = await forward_to_owner(address)
+        if forwarded is not None:
+            return forwarded
 
-        await job_queue.submit_job( device.connect )
-        await job_queue.submit_job( device.update_state )
-        await job_queue.submit_job( device.unlatch )
-        await job_queue.submit_job( device.disconnect )
+        # Don't queue commands for a device that is known to be out of reach
+        retry_policy.breaker.check(address)
 
-        return jsonify({'message': 'Unlatched successfully'}), 200
+        if is_async_request(data):
+            return submit_async_command(data, 'unlatch', supersede)
+
+        # Identical commands in a row are executed once
+        job = job_queue.submit_job( async_execute_lock_action, address=address, config=config, action='unlatch', lane=device_lane(address),
+            priority=JobQueue.PRIORITY_ACTUATION, timeout=timeout, coalesce_key='unlatch', supersede_group='action' if supersede else None )
+        await job
+
+        return jsonify({'message': 'Unlatched successfully', 'coalesced': job.coalesced, 'timing': job_timing(job)}), 200
+    except asyncio.TimeoutError:
+        return jsonify({'error': f'Device did not respond within {timeout} seconds'}), 504
+    except JobSupersededError as e:
+        return jsonify({'error': str(e)}), 409
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -445,12 +830,52 @@ async def state():
       type: string
       required: true
       description: The MAC address of the device
+    - name: maxAge
+      in: query
+      type: number
+      required: false
+      description: Maximum age in seconds of a cached state that is acceptable. Defaults to 0 which always queries the device.
+    - name: timeout
+      in: query
+      type: number
+      required: false
+      description: Seconds to wait for the device including the time the request is queued
+    - name: fields
+      in: query
+      type: string
+      required: false
+      description: Comma separated fields to return, e.g. lockState,doorSensorState. Defaults to all.
+    - name: codes
+      in: query
+      type: boolean
+      required: false
+      description: Return the enum fields as numeric codes instead of names, see /state/schema
+    - name: help
+      in: query
+      type: boolean
+      required: false
+      description: Include the possible values of the enum fields, better fetched once from /state/schema
     responses:
         200:
             description: Successfully retrieved device state
             schema:
                 type: object
                 properties:
+                    sampleAge:
+                        type: number
+                        description: Age of the returned state in seconds
+                    coalesced:
+                        type: integer
+                        description: Number of other requests that were answered by the same query
+                    timing:
+                        type: object
+                        properties:
+                            queueWait:
+                                type: number
+                                description: Seconds the request waited in the queue
+                            execution:
+                                type: number
+                                description: Seconds spent talking to the device
                     name:
                         type: string
                         description: Name of the device
@@ -472,6 +897,9 @@ async def state():
                     batteryPercentage:
                         type: integer
                         description: Battery percentage of the device
+                    batteryCritical:
+                        type: boolean
+                        description: Whether the battery is critically low
                     deviceType:
                         type: string
                         description: Type of the device
@@ -489,6 +917,7 @@ async def state():
                         description: Overall state of the device
                     help:
                         type: object
+                        description: Only with help=true
                         properties:
                             lockStateValues:
                                 type: string
@@ -506,60 +935,478 @@ async def state():
                                 type: string
                                 description: Possible device state values
         400:
-            description: MAC address is missing or device not paired
+            description: MAC address is missing, device not paired or unknown field requested
+        503:
+            description: Too many queued requests or the device is out of reach, retry after the time given in the Retry-After header
+        502:
+            description: The node of the cluster handling the device failed to answer, the command may have been executed
+        504:
+            description: Device or the node of the cluster handling it did not respond in time
         500:
             description: Error while retrieving the device state
     """
     try:
-        # Your logic for getting the state goes here
+        fields = state_schema.StateSchema.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
         # Get JSON data from the request
         address: str = request.args.get('address')
-        
-        pairedDevice, device, ble_device = await job_queue.submit_job( async_get_paired_device, address=address, config=config)
-
-        if ble_device == None:
-            raise ConnectionError(f"Device with address {address} is not reachable.")
-
-        await job_queue.submit_job( device.connect )
-        await job_queue.submit_job( device.update_state )
-        update_and_save_device_info(device, address, config)
-        await job_queue.submit_job( device.disconnect )
-
-        state = {
-            'name': pairedDevice['name'],
-            'id': pairedDevice['id'],
-            'firmwareVersion': '.'.join([str(e) for e in device.config.firmware_version]),
-            'hardwareRevision': '.'.join([str(e) for e in device.config.hardware_revision]),
-            'pairingEnabled': device.config.pairing_enabled,
-            'lockState': str(device.keyturner_state.lock_state),
-            'batteryPercentage': device.battery_percentage,
-            'deviceType': str(device.device_type),
-            'nightmodeActive': device.keyturner_state.nightmode_active,
-            'lastAction': str(device.keyturner_state.last_lock_action),
-            'doorSensorState': str(device.keyturner_state.door_sensor_state),
-            'deviceState': str(device.keyturner_state.nuki_state),
-            'help': {
-                'lockStateValues': ', '.join([e for e in pyNukiBT.NukiLockConst.LockState.ksymapping.values()]),
-                'deviceTypeValues:': ', '.join([e for e in pyNukiBT.NukiLockConst.NukiDeviceType.ksymapping.values()]),
-                'lastActionValues': ', '.join([e for e in pyNukiBT.NukiLockConst.LockAction.ksymapping.values()]),
-                'doorSensorStateValues': ', '.join([e for e in pyNukiBT.NukiLockConst.DoorsensorState.ksymapping.values()]),
-                'deviceStateValues': ', '.join([e for e in pyNukiBT.NukiLockConst.State.ksymapping.values()])
-            }
-        }
+        maxAge: float = request.args.get('maxAge', default=0, type=float)
+        timeout: float = request.args.get('timeout', default=config['requestTimeout'], type=float)
+        if not address:
+            return jsonify({'error': 'MAC address is missing'}), 400
+
+        # Answer right away if the caller accepts the age of the cached state
+        cached = state_cache.get(address, maxAge)
+        job = None
+        if cached is None:
+            forwarded = await forward_to_owner(address)
+            if forwarded is not None:
+                return forwarded
+            retry_policy.breaker.check(address)
+            # Concurrent pollers share one query
+            job = job_queue.submit_job( async_get_device_state, address=address, config=config, max_age=maxAge, lane=device_lane(address),
+                priority=JobQueue.PRIORITY_STATUS, timeout=timeout, coalesce_key='state' )
+            cached = await job
 
-        del device
-        del ble_device
+        state, age = cached
+        schema = state_schema.SCHEMA
+        result = schema.serialize({'sampleAge': round(age, 3), 'coalesced': job.coalesced if job else 0, 'timing': job_timing(job), **state},
+            fields, codes=request.args.get('codes', default=False, type=query_flag))
+        if request.args.get('help', default=False, type=query_flag):
+            result['help'] = schema.help
 
-        return jsonify(state), 200
+        return jsonify(result), 200
+    except asyncio.TimeoutError:
+        return jsonify({'error': f'Device did not respond within {timeout} seconds'}), 504
+    except JobQueueFullError as e:
+        return queue_full_response(e)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.get('/state/schema')
+def state_schema_endpoint():
+    """
+    Possible values of the enum fields of /state
+    ---
+    tags:
+        - Status
+    responses:
+        200:
+            description: >
+                The fields /state can return, the numeric code of every value of its enum fields (as returned
+                with codes=true) and the values as readable lists. Only changes with the pyNukiBT version, so
+                clients should fetch it once and revalidate with If-None-Match.
+            schema:
+                type: object
+                properties:
+                    fields:
+                        type: array
+                        items:
+                            type: string
+                    enums:
+                        type: object
+                        description: Field name -> value name -> numeric code
+                    help:
+                        type: object
+        304:
+            description: The schema matches the ETag given in If-None-Match
+    """
+    schema = state_schema.SCHEMA
+    response = Response(schema.json, mimetype='application/json', headers={'Cache-Control': 'public, max-age=86400'})
+    response.set_etag(schema.etag)
+    return response.make_conditional(request)
+
+def query_flag(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes')
+
+@app.post('/batch')
+async def batch():
+    """
+    Execute several commands in one request
+    ---
+    tags:
+        - Control
+    parameters:
+    - name: items
+      in: body
+      required: true
+      description: The commands to execute
+      schema:
+      type: object
+      properties:
+          items:
+              type: array
+              items:
+                  type: object
+                  properties:
+                      address:
+                          type: string
+                          description: The MAC address
+                      action:
+                          type: string
+                          enum: [lock, unlock, unlatch, state]
+                          description: The command to execute
+                      maxAge:
+                          type: number
+                          description: Maximum age in seconds of a cached state that is acceptable (state only)
+          timeout:
+              type: number
+              description: Seconds to wait for each command including the time it is queued
+    responses:
+        200:
+            description: >
+                All commands have been processed. Commands for different devices run in parallel, commands for
+                the same device in the given order. Every item of `results` has its own `status` (200, 409, 503,
+                504 or 500) along with the fields the corresponding single request would return.
+            schema:
+                type: object
+                properties:
+                    elapsed:
+                        type: number
+                        description: Seconds the whole batch took
+                    results:
+                        type: array
+                        items:
+                            type: object
+        400:
+            description: The list of commands is missing or malformed
+    """
+    try:
+        data = request.get_json()
+        items = data['items']
+        timeout: float = float(data.get('timeout', config['requestTimeout']))
+        for item in items:
+            if not item.get('address') or item.get('action') not in BATCH_ACTIONS:
+                raise ValueError(f"Every item needs an address and one of the actions {', '.join(BATCH_ACTIONS)}")
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    start = time.monotonic()
+
+    # Queue everything up front, the job queue spreads it over the devices
+    jobs = [submit_batch_item(item, timeout) for item in items]
+    results = await asyncio.gather(*[async_batch_item_result(item, job, timeout) for item, job in zip(items, jobs)])
+
+    return jsonify({'elapsed': round(time.monotonic() - start, 3), 'results': results}), 200
+
+@app.get('/events')
+async def events():
+    """
+    Stream state changes of paired devices as Server-Sent Events
+    ---
+    tags:
+        - Status
+    parameters:
+    - name: address
+      in: query
+      type: string
+      required: false
+      description: Comma separated MAC addresses of the devices to watch. Defaults to all paired devices.
+    responses:
+        200:
+            description: >
+                Endless text/event-stream. On connect the last known state and reachability of every watched
+                device is sent. `state` events carry the changed fields of lockState, doorSensorState,
+                batteryPercentage, batteryCritical and deviceState, `reachability` events carry isReachable
+                and rssi. A `dropped` event tells how many events a slow client has missed.
+        400:
+            description: One of the given devices has not been paired
+    """
+    addresses = [a.strip() for arg in request.args.getlist('address') for a in arg.split(',') if a.strip()]
+    for address in addresses:
+        if registry.get(address) is None:
+            return jsonify({'error': f'Device with address {address} has not been paired yet.'}), 400
+
+    if config['serverMode'] == 'asgi':
+        # Streamed on the server loop without blocking a thread per client
+        stream = async_event_stream(state_monitor.subscribe(addresses, loop=asyncio.get_running_loop()))
+    else:
+        stream = event_stream(state_monitor.subscribe(addresses))
+
+    return Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def submit_batch_item(item: dict, timeout: float):
+    address = item['address']
+    action = item['action']
+    try:
+        if action == 'state':
+            # The cache is checked when the job runs, after earlier commands of the batch for this device
+            maxAge = float(item.get('maxAge', 0))
+            return job_queue.submit_job( async_get_device_state, address=address, config=config, max_age=maxAge, lane=device_lane(address),
+                priority=JobQueue.PRIORITY_STATUS, timeout=timeout, coalesce_key='state' )
+
+        return job_queue.submit_job( async_execute_lock_action, address=address, config=config, action=action, lane=device_lane(address),
+            priority=JobQueue.PRIORITY_ACTUATION, timeout=timeout, coalesce_key=action )
+    except Exception as e:
+        return e
+
+async def async_batch_item_result(item: dict, job, timeout: float) -> Dict[str, any]:
+    result = {'address': item['address'], 'action': item['action']}
+    try:
+        if isinstance(job, Exception):
+            raise job
+
+        value = await job
+        result.update({'status': 200, 'coalesced': job.coalesced, 'timing': job_timing(job)})
+        if item['action'] == 'state':
+            state, age = value
+            result.update({'sampleAge': round(age, 3), **state})
+        return result
+    except Exception as e:
+        return {**result, **command_error(e, timeout)}
+
+def command_error(e: BaseException, timeout: float) -> Dict[str, any]:
+    # The status and error a failed command would have been answered with
+    if isinstance(e, asyncio.TimeoutError):
+        return {'status': 504, 'error': f'Device did not respond within {timeout} seconds'}
+    if isinstance(e, JobSupersededError):
+        return {'status': 409, 'error': str(e)}
+    if isinstance(e, (JobQueueFullError, CircuitOpenError)):
+        return {'status': 503, 'error': str(e), 'retryAfter': e.retry_after}
+    return {'status': 500, 'error': str(e)}
+
+def is_async_request(data: Dict[str, any]) -> bool:
+    value = data.get('async', request.args.get('async', False))
+    if isinstance(value, str):
+        return query_flag(value)
+    return bool(value)
+
+def submit_async_command(data: Dict[str, any], action: str, supersede: bool):
+    address = data['address']
+    # Like any other request, so that a hanging device doesn't block its lane forever
+    timeout = float(data.get('timeout', config['requestTimeout']))
+    submit = lambda: job_queue.submit_job( async_execute_lock_action, address=address, config=config, action=action, lane=device_lane(address),
+        priority=JobQueue.PRIORITY_ACTUATION, timeout=timeout, coalesce_key=action, supersede_group='action' if supersede else None )
+
+    # A retried request must not execute the command twice, the key only stands for the same command on the same device
+    job = job_store.submit(submit, {'address': address, 'action': action, 'timeout': timeout}, callback_url=data.get('callbackUrl'),
+        idempotency_key=request.headers.get('Idempotency-Key'), scope=(address.upper(), action))
+
+    return jsonify(describe_job(job)), 202, {'Location': f'/jobs/{job.id}'}
+
+def describe_job(job: StoredJob) -> Dict[str, any]:
+    result = {
+        'id': job.id,
+        'address': job.info['address'],
+        'action': job.info['action'],
+        'status': job.status,
+        'createdAt': format_timestamp(job.createdAt),
+        'finishedAt': format_timestamp(job.finishedAt),
+        'coalesced': job.handle.coalesced,
+        'timing': job_timing(job.handle),
+    }
+
+    future = job.handle.future
+    if future.done():
+        exception = JobCancelledError('Job has been cancelled') if future.cancelled() else future.exception()
+        result['result'] = command_error(exception, job.info['timeout']) if exception is not None else {'status': 200}
+    return result
+
+def format_timestamp(timestamp: float) -> str:
+    if timestamp is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def job_timing(job: JobHandle) -> Dict[str, float]:
+    if job is None:
+        return {'queueWait': 0.0, 'execution': 0.0}
+    return {'queueWait': round(job.wait_time, 3), 'execution': round(job.execution_time, 3)}
+
+def queue_full_response(e: JobQueueFullError):
+    return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+def circuit_open_response(e: CircuitOpenError):
+    return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+@app.get('/jobs/<job_id>')
+def get_job(job_id: str):
+    """
+    Status of an asynchronous command
+    ---
+    tags:
+        - Control
+    parameters:
+    - name: job_id
+      in: path
+      type: string
+      required: true
+      description: The job ID returned when the command was queued
+    responses:
+        200:
+            description: >
+                Current status of the job (queued, running, succeeded or failed). Finished jobs carry a `result`
+                with the status and error the command would have been answered with if it had been awaited.
+            schema:
+                type: object
+                properties:
+                    id:
+                        type: string
+                    address:
+                        type: string
+                    action:
+                        type: string
+                    status:
+                        type: string
+                        enum: [queued, running, succeeded, failed]
+                    createdAt:
+                        type: string
+                    finishedAt:
+                        type: string
+                    coalesced:
+                        type: integer
+                        description: Number of other submissions served by the same execution
+                    timing:
+                        type: object
+                    result:
+                        type: object
+        404:
+            description: Unknown job, or finished longer than asyncJobTtl seconds ago
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} does not exist or has expired'}), 404
+    return jsonify(describe_job(job)), 200
+
+@app.get('/cluster')
+def cluster_status():
+    """
+    Nodes of the cluster and which node handles each paired device
+    ---
+    tags:
+        - Status
+    responses:
+        200:
+            description: Nodes that reported recently and the owner of every paired device
+            schema:
+                type: object
+                properties:
+                    node:
+                        type: string
+                        description: ID of the node answering
+                    nodes:
+                        type: array
+                        items:
+                            type: object
+                            properties:
+                                id:
+                                    type: string
+                                    description: ID of the node
+                                url:
+                                    type: string
+                                    description: URL the other nodes forward requests to
+                                age:
+                                    type: number
+                                    description: Seconds since the node reported last
+                                rssi:
+                                    type: object
+                                    description: Signal strength the node receives each paired device with
+                    owners:
+                        type: object
+                        description: ID of the node handling each paired device by its address
+        404:
+            description: The server is not part of a cluster
+    """
+    if cluster is None:
+        return jsonify({'error': 'Cluster mode is not enabled'}), 404
+    return jsonify(cluster.status()), 200
+
+@app.get('/keepWarm')
+def keep_warm_status():
+    """
+    Status of the keep warm policy
+    ---
+    tags:
+        - Status
+    responses:
+        200:
+            description: Warm hit rate and why each paired device is kept warm
+            schema:
+                type: object
+                properties:
+                    enabled:
+                        type: boolean
+                        description: Whether links are kept warm at all
+                    hitRate:
+                        type: number
+                        description: Share of requests that found an open link
+                    devices:
+                        type: array
+                        items:
+                            type: object
+                            properties:
+                                address:
+                                    type: string
+                                    description: MAC address of the device
+                                reason:
+                                    type: string
+                                    description: Why the link is kept warm right now (schedule, hot or predicted), null if not
+                                isWarm:
+                                    type: boolean
+                                    description: Whether a link is open
+                                commandsLastHour:
+                                    type: integer
+                                    description: Commands sent to the device in the last hour
+                                budgetLeft:
+                                    type: number
+                                    description: Seconds of extra idle link time left for today
+                                hits:
+                                    type: integer
+                                    description: Requests that found an open link
+                                misses:
+                                    type: integer
+                                    description: Requests that had to connect
+                                preconnects:
+                                    type: integer
+                                    description: Links opened ahead of time
+    """
+    return jsonify(keep_warm.status()), 200
+
+@app.get('/metrics')
+def metrics_endpoint():
+    """
+    Metrics in the Prometheus text format
+    ---
+    tags:
+        - Status
+    responses:
+        200:
+            description: >
+                Latency histograms of scans, BLE operations, queue waits, job executions and config saves,
+                counters of failed jobs by error type, cache hits and misses and reconnects, and gauges of the
+                job queue depth.
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_trace():
+    # Jobs and BLE operations started by this request add their spans to its trace
+    tracing.TRACER.start_trace(f'{request.method} {request.path}', request.headers.get('traceparent'),
+        method=request.method, path=request.path)
+
+@app.after_request
+def end_trace(response: Response):
+    span = tracing.current_span()
+    if span is not None:
+        span.set_attribute('status', response.status_code)
+        if response.status_code >= 500:
+            span.error = response.status
+        tracing.TRACER.end(span)
+        response.headers['X-Trace-Id'] = span.traceId
+    return response
+
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify({'error': 'Endpoint not found'}), 404
 
 def default_config():
 
+    from nacl.public import PrivateKey
+
     keypair = PrivateKey.generate()
     public_key = base64.b64encode(bytes(keypair.public_key)).decode('utf-8')
     private_key = base64.b64encode(bytes(keypair)).decode('utf-8')
@@ -571,7 +1418,49 @@ def default_config():
         'publicKey': public_key,
         'pairedDevices': [],
         'apiPort': 51001,
-        'apiBindAddress': '0.0.0.0'
+        'apiBindAddress': '0.0.0.0',
+        'maxConcurrentJobs': 3,
+        'connectionIdleTimeout': 20,
+        'maxOpenConnections': 3,
+        'scanCacheMaxAge': 30,
+        'listPairedTimeout': 30,
+        'configSaveDelay': 5,
+        'maxQueueDepth': 100,
+        'requestTimeout': 60,
+        'serverMode': 'flask',
+        'eventBufferSize': 100,
+        'backend': 'bluetooth',
+        'adapters': [],
+        'keepWarm': False,
+        'keepWarmIdleTimeout': 300,
+        'keepWarmHotRate': 4,
+        'keepWarmPredictThreshold': 0.5,
+        'keepWarmPredictMinDays': 3,
+        'keepWarmBudget': 1800,
+        'keepWarmSchedules': [],
+        'asyncJobTtl': 3600,
+        'asyncJobLimit': 1000,
+        'webhookTimeout': 10,
+        'apiDocs': True,
+        'apiSpecCache': './settings/apispec.json',
+        'bleRetryAttempts': 3,
+        'bleRetryBaseDelay': 0.5,
+        'bleRetryMaxDelay': 5,
+        'circuitBreakerThreshold': 3,
+        'circuitBreakerResetTimeout': 30,
+        'circuitBreakerMaxResetTimeout': 600,
+        'tracing': False,
+        'traceExporter': 'file',
+        'traceFile': './settings/traces.jsonl',
+        'cluster': False,
+        'clusterStore': 'file',
+        'clusterStorePath': './settings/cluster.json',
+        'clusterNodeId': '',
+        'clusterNodeUrl': '',
+        'clusterSyncInterval': 10,
+        'clusterNodeTtl': 30,
+        'clusterForwardTimeout': 90,
+        'simulatedDevices': []
     }
 
 def load_config(file_path):
@@ -591,10 +1480,75 @@ def load_config(file_path):
             print(f"Error decoding JSON from file {file_path}. Returning default config.")
             return default_config()
 
+def save_registry(config: Dict[str, any]):
+    save_config(configPath, config)
+    if cluster is not None:
+        cluster.publish(config['pairedDevices'])
+
+def local_rssi(address: str) -> int:
+    # Best signal of the device on any adapter, None if it is out of reach
+    rssi = adapter_selector.rssi(address)
+    if not rssi or retry_policy.breaker.state(address) == retry_policy.breaker.OPEN:
+        return None
+    return max(rssi.values())
+
+async def forward_to_owner(address: str):
+    """
+    Hand the request to the node of the cluster that handles the device.
+    Returns its response, None if this node handles the request itself.
+    """
+    if cluster is None or not address or request.headers.get(cluster_module.FORWARDED_HEADER):
+        return None
+    node = cluster.owner(address)
+    if node is None:
+        return None
+
+    headers = {cluster_module.FORWARDED_HEADER: cluster.nodeId}
+    for name in ('Content-Type', 'Idempotency-Key', 'traceparent'):
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    with tracing.span('forward', node=node['id']) as span:
+        if span is not None:
+            headers['traceparent'] = f'00-{span.traceId}-{span.spanId}-01'
+        try:
+            status, body, responseHeaders = await asyncio.to_thread(cluster_module.forward, node['url'], request.method,
+                request.full_path, request.get_data(), headers, config['clusterForwardTimeout'])
+        except ConnectionError as e:
+            logger.warning(f"Handling request for {address} here: {e}")
+            cluster_module.CLUSTER_FORWARDS.inc(result='fallback')
+            return None
+        except cluster_module.ForwardError as e:
+            # The owner might have executed the command already, running it here could do it twice
+            logger.warning(f"Forwarded request for {address} failed: {e}")
+            cluster_module.CLUSTER_FORWARDS.inc(result='failed')
+            return jsonify({'error': str(e)}), 504 if e.timed_out else 502, {'X-Served-By': node['id']}
+
+    cluster_module.CLUSTER_FORWARDS.inc(result='forwarded')
+    response = Response(body, status, content_type=responseHeaders.get('Content-Type'))
+    response.headers['X-Served-By'] = node['id']
+    if 'Retry-After' in responseHeaders:
+        response.headers['Retry-After'] = responseHeaders['Retry-After']
+    if 'Location' in responseHeaders:
+        # Jobs of asynchronous commands are polled on the node running them
+        location = responseHeaders['Location']
+        response.headers['Location'] = node['url'] + location if location.startswith('/') else location
+    return response
+
+def on_cluster_device_changed(address: str):
+    # Paired again or removed by another node, the keys in use might be outdated
+    job_queue.submit_job( async_forget_device, address, lane=device_lane(address), priority=JobQueue.PRIORITY_MAINTENANCE )
+
 def save_config(file_path, config):
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, 'w') as file:
-        json.dump(config, file, indent=4)
+    with CONFIG_SAVE_SECONDS.time(), tracing.span('save_config'):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # Write to a temporary file first so that the config is never left half written
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(config, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
 
 def sync_dictionaries(reference_dict, target_dict):
     # Remove keys not in reference_dict
@@ -607,59 +1561,376 @@ def sync_dictionaries(reference_dict, target_dict):
 
     return target_dict
 
-def replace_or_add_entry_by_address(data_list: List[any], new_entry: Dict[str, any]) -> List[any]:
-    for i, item in enumerate(data_list):
-        if item.get('address').upper() == new_entry['address'].upper():
-            data_list[i] = new_entry
-            return data_list
-        
-    data_list.append(new_entry)
-
-    return data_list
-
-def update_and_save_device_info(device: pyNukiBT.NukiDevice, address: str, config: Dict[str, any]):
+def update_and_save_device_info(device: pyNukiBT.NukiDevice, address: str):
     
-    # Get Paired device entry from config
     # Check if the address is provided
     if not address:
         raise ValueError('MAC address is missing')
-    
-    # Check if address is paired
-    pairedDevice = next((item for item in config['pairedDevices'] if item.get('address').lower() == address.lower()), None)
-    if pairedDevice == None:
-        raise LookupError(f'Device with address {address} has not been paired yet.')
 
-    pairedDevice['name'] = device.config.name
-    pairedDevice['id'] = device.config.nuki_id
+    # Only marks the config for saving if something has changed
+    return registry.update_info(address, device.config.name, device.config.nuki_id)
 
-    save_config(configPath, config)
-
-async def async_get_paired_device(address: str, config: Dict[str, any]) -> Tuple[dict,pyNukiBT.NukiDevice,BLEDevice]:
+async def async_get_paired_device(address: str, config: Dict[str, any], adapter: str = None) -> Tuple[dict,pyNukiBT.NukiDevice,BLEDevice]:
     # Check if the address is provided
     if not address:
         raise ValueError('MAC address is missing')
         
     # Check if address is paired
-    pairedDevice = next((item for item in config['pairedDevices'] if item.get('address').lower() == address.lower()), None)
+    pairedDevice = registry.get(address)
     if pairedDevice == None:
         raise LookupError(f'Device with address {address} has not been paired yet.')
 
-    ble_device: BLEDevice = await BleakScanner.find_device_by_address(address)
-    device: pyNukiBT.NukiDevice = pyNukiBT.NukiDevice(address=address, 
+    with tracing.span('find_device_by_address', address=address, adapter=adapter or 'default'):
+        ble_device: BLEDevice = await scanner.find_device_by_address(address, adapter=adapter)
+
+    # Reuse the device object and its derived keys, only the BLE device is refreshed
+    device: pyNukiBT.NukiDevice = device_handles.get(address)
+    if ble_device != None:
+        device.set_ble_device(ble_device)
+
+    return pairedDevice, device, ble_device
+
+def nuki_device_class():
+    return device_class or pyNukiBT.NukiDevice
+
+def create_nuki_device(address: str, config: Dict[str, any]) -> pyNukiBT.NukiDevice:
+    pairedDevice = registry.get(address)
+    if pairedDevice == None:
+        raise LookupError(f'Device with address {address} has not been paired yet.')
+
+    device = nuki_device_class()(address=pairedDevice['address'], 
             auth_id=base64.b64decode(pairedDevice['authId']), 
             nuki_public_key=base64.b64decode(pairedDevice['devicePublicKey']),
             bridge_public_key=base64.b64decode(config['publicKey']), 
             bridge_private_key=base64.b64decode(config['privateKey']),
             app_id=config['appId'], name=config['appName'], client_type=pyNukiBT.NukiConst.NukiClientType.BRIDGE, 
-            ble_device=ble_device, 
-            get_ble_device=lambda addr: BleakScanner.find_device_by_address(address))
+            get_ble_device=lambda addr: scanner.get_device(address))
+    device.subscribe(lambda command: on_device_notification(address, device, command))
 
-    return pairedDevice, device, ble_device
+    return device
+
+async def async_forget_device(address: str):
+    await connection_manager.close(address)
+    device_handles.invalidate(address)
+    state_cache.invalidate(address)
+
+def device_lane(address: str) -> str:
+    # All jobs touching the same device share one lane of the job queue
+    return address.upper() if address else None
+
+def lane_adapter(lane: str) -> str:
+    # Every adapter has its own budget of concurrent jobs
+    return connection_manager.adapter(lane) if lane else None
+
+def reserve_lane(lane: str) -> bool:
+    # A device job only starts once a link slot on its adapter is free
+    return lane is None or connection_manager.try_reserve(lane)
+
+def release_lane(lane: str):
+    if lane is not None:
+        connection_manager.release_reservation(lane)
+
+async def async_execute_lock_action(address: str, config: Dict[str, any], action: str):
+    key = address.upper()
+    keep_warm.record_command(address)
+    try:
+        async with retry_policy.connection(address, lambda: connection_manager.connection(address)) as device:
+            with BLE_OPERATION_SECONDS.time(operation='update_state', address=key), tracing.span('update_state', address=key):
+                await retry_policy.call(address, 'update_state', device.update_state)
+            # Unlatching twice would open the door twice, lock and unlock may be repeated
+            with BLE_OPERATION_SECONDS.time(operation=action, address=key), tracing.span(action, address=key):
+                await retry_policy.call(address, action, getattr(device, action), retry=action != 'unlatch')
+    finally:
+        state_cache.invalidate(address)
+
+async def async_get_device_state(address: str, config: Dict[str, any], max_age: float = 0, record_usage: bool = True) -> Tuple[Dict[str, any], float]:
+    # A request queued before us might just have fetched the state
+    cached = state_cache.get(address, max_age)
+    if cached is not None:
+        return cached
+
+    # Only requests of clients tell when the device is used
+    if record_usage:
+        keep_warm.record_command(address)
+    async with retry_policy.connection(address, lambda: connection_manager.connection(address)) as device:
+        with BLE_OPERATION_SECONDS.time(operation='update_state', address=address.upper()), tracing.span('update_state', address=address.upper()):
+            await retry_policy.call(address, 'update_state', device.update_state)
+        pairedDevice = update_and_save_device_info(device, address)
+
+    state = {
+        'name': pairedDevice['name'],
+        'id': pairedDevice['id'],
+        'firmwareVersion': '.'.join([str(e) for e in device.config.firmware_version]),
+        'hardwareRevision': '.'.join([str(e) for e in device.config.hardware_revision]),
+        'pairingEnabled': device.config.pairing_enabled,
+        'deviceType': str(device.device_type),
+        **keyturner_state_fields(device),
+    }
+
+    state_cache.put(address, state)
+    state_monitor.on_state(address, state)
+
+    return state, 0.0
+
+def keyturner_state_fields(device: pyNukiBT.NukiDevice) -> Dict[str, any]:
+    return {
+        'lockState': str(device.keyturner_state.lock_state),
+        'batteryPercentage': device.battery_percentage,
+        'batteryCritical': device.is_battery_critical,
+        'nightmodeActive': device.keyturner_state.nightmode_active,
+        'lastAction': str(device.keyturner_state.last_lock_action),
+        'doorSensorState': str(device.keyturner_state.door_sensor_state),
+        'deviceState': str(device.keyturner_state.nuki_state),
+    }
+
+def on_device_notification(address: str, device: pyNukiBT.NukiDevice, command):
+    # The device pushes its new state by itself while we are connected
+    if command == pyNukiBT.NukiConst.NukiCommand.KEYTURNER_STATES:
+        state_cache.invalidate(address)
+        state_monitor.on_state(address, keyturner_state_fields(device))
+
+def warm_up_device(address: str):
+    # Called by the keep warm policy when a command is likely
+    job_queue.submit_job( async_warm_up_device, address=address, lane=device_lane(address),
+        priority=JobQueue.PRIORITY_MAINTENANCE, coalesce_key='warm' )
+
+async def async_warm_up_device(address: str):
+    try:
+        # The link stays open as long as the policy wants it to
+        async with retry_policy.connection(address, lambda: connection_manager.connection(address)):
+            pass
+    finally:
+        keep_warm.preconnect_done(address)
+
+def refresh_device_state(address: str):
+    # Called by the state monitor when a device advertises a state change
+    job_queue.submit_job( async_get_device_state, address=address, config=config, record_usage=False, lane=device_lane(address),
+        priority=JobQueue.PRIORITY_MAINTENANCE, coalesce_key='state' )
+
+def format_events(events: List[dict], dropped: int) -> str:
+    chunks = []
+    if dropped:
+        chunks.append(f"event: dropped\ndata: {json.dumps({'count': dropped})}\n\n")
+    for event in events:
+        chunks.append(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n")
+
+    return ''.join(chunks) or ': keepalive\n\n'
+
+def event_stream(subscription: Subscription):
+    try:
+        while True:
+            yield format_events(*subscription.get(EVENT_KEEPALIVE_INTERVAL))
+    finally:
+        state_monitor.unsubscribe(subscription)
+
+async def async_event_stream(subscription: Subscription):
+    try:
+        while True:
+            yield format_events(*await subscription.async_get(EVENT_KEEPALIVE_INTERVAL))
+    finally:
+        state_monitor.unsubscribe(subscription)
+
+async def async_create_device(address: str, adapter: str = None) -> pyNukiBT.NukiDevice:
+    _, device, ble_device = await async_get_paired_device(address, config, adapter)
+
+    if ble_device == None:
+        raise ConnectionError(f"Device with address {address} is not reachable.")
+
+    return device
+
+def init_services(loaded_config: Dict[str, any]):
+    """
+    Set up the services for the given config. Reused by benchmark.py.
+    """
+    global config, registry, job_queue, connection_manager, scanner, state_cache, device_handles, device_class, \
+        adapter_selector, keep_warm, state_monitor, job_store, retry_policy, cluster
+
+    config = loaded_config
+    tracing.configure(tracing.create_exporter(config['traceExporter'], config['traceFile']) if config['tracing'] else None)
+    registry = DeviceRegistry(config, save_registry, save_delay=config['configSaveDelay'])
+    state_cache = StateCache()
+    device_handles = DeviceHandleCache(lambda address: create_nuki_device(address, config))
+
+    scannerArgs = {}
+    if config['backend'] == 'simulator':
+        # Talk to simulated locks instead of the radio
+        from simulator import Simulation
+        simulation = Simulation(config['simulatedDevices'])
+        device_class = simulation.device_class
+        scannerArgs['scanner_class'] = simulation.scanner_class
+    else:
+        device_class = None
+
+    # Every adapter has its own scanner and its own budget of jobs and open links
+    adapters = config['adapters'] or [None]
+    adapter_selector = AdapterSelector(adapters, lambda address: (registry.get(address) or {}).get('adapter'),
+        max_age=config['scanCacheMaxAge'])
+    scanner = MultiAdapterScanner({adapter: DeviceScanner(max_age=config['scanCacheMaxAge'], adapter=adapter, **scannerArgs)
+        for adapter in adapters}, adapter_selector)
+    keep_warm = KeepWarmPolicy(lambda: [e['address'] for e in registry.entries()], warm_up_device,
+        lambda address: connection_manager.is_open(address), enabled=config['keepWarm'],
+        base_idle_timeout=config['connectionIdleTimeout'], idle_timeout=config['keepWarmIdleTimeout'],
+        hot_rate=config['keepWarmHotRate'], predict_threshold=config['keepWarmPredictThreshold'], predict_min_days=config['keepWarmPredictMinDays'],
+        budget=config['keepWarmBudget'], schedules=config['keepWarmSchedules'])
+    connection_manager = MultiAdapterConnectionManager({adapter: ConnectionManager(
+            lambda address, adapter=adapter: async_create_device(address, adapter),
+            idle_timeout=config['connectionIdleTimeout'], max_connections=config['maxOpenConnections'], keep_warm=keep_warm)
+        for adapter in adapters}, adapter_selector)
+    job_queue = JobQueue(max_concurrency=config['maxConcurrentJobs'], max_queue_depth=config['maxQueueDepth'],
+        lane_group=lane_adapter, reserve=reserve_lane, release=release_lane)
+    job_store = JobStore(describe_job, max_jobs=config['asyncJobLimit'], ttl=config['asyncJobTtl'], webhook_timeout=config['webhookTimeout'])
+    retry_policy = RetryPolicy(CircuitBreaker(failure_threshold=config['circuitBreakerThreshold'], reset_timeout=config['circuitBreakerResetTimeout'],
+            max_reset_timeout=config['circuitBreakerMaxResetTimeout']),
+        attempts=config['bleRetryAttempts'], base_delay=config['bleRetryBaseDelay'], max_delay=config['bleRetryMaxDelay'],
+        deadline=current_deadline)
+    state_monitor = StateMonitor(lambda address: registry.get(address) is not None, refresh_device_state,
+        buffer_size=config['eventBufferSize'], max_age=config['scanCacheMaxAge'])
+    scanner.add_listener(state_cache.on_advertisement)
+    scanner.add_listener(state_monitor.on_advertisement)
+    scanner.add_listener(retry_policy.breaker.on_advertisement)
+
+    if config['cluster']:
+        # Pairings are shared, commands go to the node that receives the lock best
+        nodeId = config['clusterNodeId'] or socket.gethostname()
+        cluster = cluster_module.ClusterNode(cluster_module.create_store(config['clusterStore'], config['clusterStorePath']),
+            nodeId, config['clusterNodeUrl'] or f"http://{socket.gethostname()}:{config['apiPort']}", registry, local_rssi,
+            on_cluster_device_changed, interval=config['clusterSyncInterval'], node_ttl=config['clusterNodeTtl'])
+        if cluster.join(config):
+            save_config(configPath, config)
+        job_queue.add_shutdown_hook(cluster.stop)
+    else:
+        cluster = None
+    job_queue.add_shutdown_hook(connection_manager.close_all)
+    job_queue.add_shutdown_hook(scanner.stop)
+    job_queue.add_shutdown_hook(state_monitor.stop)
+    job_queue.add_shutdown_hook(keep_warm.stop)
+
+def start_services(wait: bool = True):
+    """
+    Start the background services. With `wait` False the scanner is still
+    starting when this returns, requests meanwhile scan on demand.
+    """
+    # The job queue runs its own loop in a separate thread
+    with startup_timer.phase('jobQueue'):
+        job_queue.start()
+        job_queue.run_coroutine(state_monitor.start()).result()
+        job_queue.run_coroutine(keep_warm.start()).result()
+        if cluster is not None:
+            job_queue.run_coroutine(cluster.start()).result()
+    preload(['pyNukiBT', 'state_schema'], startup_timer)
+
+    scannerStart = job_queue.run_coroutine(async_start_scanner())
+    if wait:
+        scannerStart.result()
+
+async def async_start_scanner():
+    with startup_timer.phase('scanner'):
+        try:
+            await scanner.start()
+        except Exception as e:
+            logger.error(f"Could not start background scanner, falling back to scanning on demand: {e}")
+
+def stop_services():
+    job_queue.stop()
+    job_store.shutdown()
+    registry.flush()
+    tracing.shutdown()
+
+async def async_start_services():
+    # The job queue runs on the loop of the caller
+    with startup_timer.phase('jobQueue'):
+        job_queue.start(loop=asyncio.get_running_loop())
+        await state_monitor.start()
+        await keep_warm.start()
+        if cluster is not None:
+            await cluster.start()
+    preload(['pyNukiBT', 'state_schema'], startup_timer)
+
+    # Keeps starting while the server binds its socket
+    job_queue.run_coroutine(async_start_scanner())
+    logger.info(f"Services started after {startup_timer.elapsed():.3f} s ({startup_timer.summary()})")
+
+async def async_stop_services():
+    await job_queue.async_stop()
+    job_store.shutdown()
+    registry.flush()
+    tracing.shutdown()
+
+def init_api_docs(cache_path: str):
+    """
+    Set up the Swagger UI and /apispec.json. Building the spec parses every
+    docstring, so it is done once in the background and cached in
+    `cache_path`, from where later starts take it as long as the routes and
+    their docstrings are unchanged.
+    """
+    global swagger
+    from flasgger import Swagger
+
+    swagger = Swagger(app, config=swagger_config, merge=True)
+    key = api_docs_key()
+    try:
+        with open(cache_path, 'r') as file:
+            cached = json.load(file)
+        if cached.get('key') == key:
+            swagger.apispecs['apispec'] = cached['spec']
+            return
+    except (OSError, ValueError):
+        pass
+
+    threading.Thread(target=build_api_spec, args=(cache_path, key), name='apispec', daemon=True).start()
+
+def api_docs_key() -> str:
+    digest = hashlib.sha256(json.dumps(swagger_config, sort_keys=True).encode('utf-8'))
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule + rule.endpoint):
+        view = app.view_functions.get(rule.endpoint)
+        digest.update(f"{rule.rule} {sorted(rule.methods)} {getattr(view, '__doc__', None)}".encode('utf-8'))
+    return digest.hexdigest()
+
+def build_api_spec(cache_path: str, key: str):
+    try:
+        start = time.perf_counter()
+        with app.app_context():
+            spec = swagger.get_apispecs('apispec')
+        startup_timer.record('apiSpec', time.perf_counter() - start)
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'key': key, 'spec': spec}, file, default=str)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not cache the API spec: {e}")
 
 if __name__ == '__main__':
-    config = load_config(configPath)
-    save_config(configPath, config)
-    job_queue.start()
-    #app.run(debug=True, port=config['apiPort'])
-    app.run(host=config['apiBindAddress'], port=config['apiPort'])
+    with startup_timer.phase('config'):
+        loaded_config = load_config(configPath)
+        save_config(configPath, loaded_config)
+    with startup_timer.phase('services'):
+        init_services(loaded_config)
 
+    if config['apiDocs']:
+        with startup_timer.phase('apiDocs'):
+            init_api_docs(config['apiSpecCache'])
+
+    if config['serverMode'] == 'asgi':
+        # HTTP handling and BLE jobs share the event loop of the ASGI server
+        import uvicorn
+        from asgi_server import FlaskASGIAdapter
+
+        uvicorn.run(FlaskASGIAdapter(app, async_start_services, async_stop_services), host=config['apiBindAddress'], port=config['apiPort'])
+    else:
+        from werkzeug.serving import make_server
+
+        # The scanner starts while the socket is bound
+        start_services(wait=False)
+        with startup_timer.phase('httpBind'):
+            server = make_server(config['apiBindAddress'], config['apiPort'], app, threaded=True)
+        logger.info(f"Listening on {config['apiBindAddress']}:{config['apiPort']} after {startup_timer.elapsed():.3f} s "
+            f"({startup_timer.summary()})")
+
+        # Shut down cleanly when the container is stopped
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        finally:
+            stop_services()
@@ -0,0 +1,229 @@
+import asyncio
+import base64
+import logging
+import os
+import random
+from types import SimpleNamespace
+from typing import Dict, List
+from state_cache import NUKI_BEACON_MANUFACTURER_ID
+
+logger = logging.getLogger(__name__)
+
+class SimulatedLock:
+    """
+    State and behaviour of one simulated smart lock. Latencies are mean
+    values in seconds, every operation fails with probability `failureRate`.
+    `rssi` is either a number or a dict of RSSI per adapter, adapters
+    missing from it don't receive the lock.
+    """
+
+    def __init__(self, spec: Dict[str, any]):
+        self.address = spec['address'].upper()
+        self.name = spec.get('name', 'Nuki_' + self.address.replace(':', '')[-8:])
+        self.nukiId = spec.get('id', random.getrandbits(32))
+        self.connectLatency = spec.get('connectLatency', 0.5)
+        self.stateLatency = spec.get('stateLatency', 0.2)
+        self.actionLatency = spec.get('actionLatency', 1.0)
+        self.failureRate = spec.get('failureRate', 0.0)
+        self.advertisementInterval = spec.get('advertisementInterval', 1.0)
+        self.reachable = spec.get('reachable', True)
+        self.rssi = spec.get('rssi', -60)
+
+        self.lockState = 'LOCKED'
+        self.lastAction = 'NONE'
+        self.doorSensorState = 'DOOR_CLOSED'
+        self.batteryPercentage = 80
+        self.stateChanged = False
+        self.authId = base64.b64encode(os.urandom(4)).decode('utf-8')
+        self.publicKey = base64.b64encode(os.urandom(32)).decode('utf-8')
+
+    def rssi_on(self, adapter: str) -> int:
+        if not self.reachable:
+            return None
+        if isinstance(self.rssi, dict):
+            return self.rssi.get(adapter)
+        return self.rssi
+
+    async def delay(self, latency: float, operation: str, adapter: str = None):
+        # +-20 % jitter so that concurrent requests don't move in lockstep
+        await asyncio.sleep(latency * random.uniform(0.8, 1.2))
+
+        if self.rssi_on(adapter) is None:
+            raise ConnectionError(f"Simulated device {self.address} is out of range")
+        if random.random() < self.failureRate:
+            raise ConnectionError(f"Simulated {operation} failure on {self.address}")
+
+    def ble_device(self, adapter: str = None):
+        return SimpleNamespace(address=self.address, name=self.name, rssi=self.rssi_on(adapter), details={'adapter': adapter})
+
+    def advertisement_data(self, adapter: str = None):
+        # iBeacon frame, the lowest bit of the tx power byte flags a state change
+        txPower = 0xC4 | (0x01 if self.stateChanged else 0x00)
+        beacon = bytes([0x02, 0x15]) + bytes(20) + bytes([txPower])
+        return SimpleNamespace(local_name=self.name, rssi=self.rssi_on(adapter), tx_power=None, service_data={}, service_uuids=[],
+            manufacturer_data={NUKI_BEACON_MANUFACTURER_ID: beacon})
+
+class Simulation:
+    """
+    In-process replacement for the radio. `scanner_class` stands in for
+    BleakScanner and `device_class` for pyNukiBT.NukiDevice, both act on the
+    simulated locks given by `specs`.
+    """
+
+    def __init__(self, specs: List[Dict[str, any]]):
+        self.locks: Dict[str, SimulatedLock] = {}
+        for spec in specs:
+            lock = SimulatedLock(spec)
+            self.locks[lock.address] = lock
+
+        self.scanner_class = type('SimulatedScanner', (SimulatedScanner,), {'simulation': self})
+        self.device_class = type('SimulatedNukiDevice', (SimulatedNukiDevice,), {'simulation': self})
+
+    def get(self, address: str) -> SimulatedLock:
+        return self.locks.get(address.upper()) if address else None
+
+class SimulatedScanner:
+    """
+    Implements the parts of the BleakScanner interface the server uses.
+    """
+
+    simulation: Simulation = None
+
+    def __init__(self, detection_callback=None, adapter: str = None):
+        self.__detectionCallback = detection_callback
+        self.__adapter = adapter
+        self.__tasks = []
+
+    async def start(self):
+        self.__tasks = [asyncio.create_task(self.__advertise(lock)) for lock in self.simulation.locks.values()]
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+
+    async def __advertise(self, lock: SimulatedLock):
+        # Spread the first advertisements over one interval
+        await asyncio.sleep(random.uniform(0, lock.advertisementInterval))
+        while True:
+            if lock.rssi_on(self.__adapter) is not None and self.__detectionCallback is not None:
+                self.__detectionCallback(lock.ble_device(self.__adapter), lock.advertisement_data(self.__adapter))
+            await asyncio.sleep(lock.advertisementInterval)
+
+    @classmethod
+    async def discover(cls, timeout: float = 5.0, return_adv: bool = False, adapter: str = None):
+        await asyncio.sleep(timeout)
+        found = {l.address: (l.ble_device(adapter), l.advertisement_data(adapter)) for l in cls.simulation.locks.values()
+            if l.rssi_on(adapter) is not None}
+        return found if return_adv else [d for d, _ in found.values()]
+
+    @classmethod
+    async def find_device_by_address(cls, device_identifier: str, timeout: float = 10.0, adapter: str = None):
+        lock = cls.simulation.get(device_identifier)
+        if lock is None or lock.rssi_on(adapter) is None:
+            await asyncio.sleep(timeout)
+            return None
+
+        await asyncio.sleep(min(timeout, random.uniform(0, lock.advertisementInterval)))
+        return lock.ble_device(adapter)
+
+class SimulatedNukiDevice:
+    """
+    Implements the parts of the pyNukiBT.NukiDevice interface the server
+    uses. Takes the same constructor arguments.
+    """
+
+    simulation: Simulation = None
+
+    def __init__(self, address, auth_id, nuki_public_key, bridge_public_key, bridge_private_key, app_id, name,
+            client_type=None, ble_device=None, get_ble_device=None):
+        self._address = address
+        self._lock = self.simulation.get(address)
+        self._connected = False
+        self._adapter = ble_device.details['adapter'] if ble_device else None
+        self._callbacks = []
+        self.rssi = None
+        self.config = None
+        self.keyturner_state = None
+        self.last_state = None
+
+    @property
+    def device_type(self) -> str:
+        return 'SMARTLOCK_3_4'
+
+    @property
+    def battery_percentage(self) -> int:
+        return self._lock.batteryPercentage
+
+    @property
+    def is_battery_critical(self) -> bool:
+        return self._lock.batteryPercentage < 20
+
+    def set_ble_device(self, ble_device=None):
+        if ble_device is not None:
+            self.rssi = ble_device.rssi
+            self._adapter = ble_device.details['adapter']
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        return lambda: self._callbacks.remove(callback)
+
+    async def connect(self):
+        if self._connected:
+            return
+        if self._lock is None:
+            raise ConnectionError(f"Simulated device {self._address} does not exist")
+
+        await self._lock.delay(self._lock.connectLatency, 'connect', self._adapter)
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    async def pair(self):
+        await self.connect()
+        await self._lock.delay(self._lock.actionLatency, 'pair', self._adapter)
+        return {'auth_id': self._lock.authId, 'nuki_public_key': self._lock.publicKey}
+
+    async def update_state(self):
+        await self.__command(self._lock.stateLatency, 'update_state')
+        self._lock.stateChanged = False
+        self.__load_state()
+
+    async def lock(self):
+        await self.__lock_action('LOCK', 'LOCKED')
+
+    async def unlock(self):
+        await self.__lock_action('UNLOCK', 'UNLOCKED')
+
+    async def unlatch(self):
+        await self.__lock_action('UNLATCH', 'UNLATCHED')
+
+    async def __lock_action(self, action: str, lockState: str):
+        await self.__command(self._lock.actionLatency, action.lower())
+        self._lock.lockState = lockState
+        self._lock.lastAction = action
+        self._lock.stateChanged = True
+
+        # The real device pushes its new state once the motor has stopped
+        self.__load_state()
+        for callback in list(self._callbacks):
+            callback('KEYTURNER_STATES')
+
+    async def __command(self, latency: float, operation: str):
+        # Like pyNukiBT, reconnect on demand
+        await self.connect()
+        try:
+            await self._lock.delay(latency, operation, self._adapter)
+        except ConnectionError:
+            self._connected = False
+            raise
+
+    def __load_state(self):
+        lock = self._lock
+        self.keyturner_state = SimpleNamespace(lock_state=lock.lockState, nightmode_active=False, last_lock_action=lock.lastAction,
+            door_sensor_state=lock.doorSensorState, nuki_state='DOOR_MODE')
+        self.last_state = self.keyturner_state
+        self.config = SimpleNamespace(name=lock.name, nuki_id=lock.nukiId, firmware_version=[4, 0, 0], hardware_revision=[1, 0],
+            pairing_enabled=True)
@@ -0,0 +1,81 @@
+import contextlib
+import importlib
+import logging
+import threading
+import time
+from typing import Dict, Iterable
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge('nuki_startup_seconds', 'Time spent in each phase of the server startup', ['phase'])
+
+class LazyModule:
+    """
+    Stands in for a module that is imported the first time one of its
+    attributes is used, so that importing this server doesn't pay for
+    libraries a code path never touches.
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+
+    def __getattr__(self, attribute: str):
+        # Only a lookup in sys.modules once the module has been imported
+        return getattr(importlib.import_module(self.__name), attribute)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self.__name}'>"
+
+class StartupTimer:
+    """
+    Records how long each phase of the startup took. Phases may finish in
+    any order and on any thread, e.g. the background scanner.
+    """
+
+    def __init__(self):
+        self.__start = time.perf_counter()
+        self.__phases: Dict[str, float] = {}
+        self.__lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.__start
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        with self.__lock:
+            self.__phases[name] = seconds
+        STARTUP_SECONDS.set(seconds, phase=name)
+
+    def report(self) -> Dict[str, float]:
+        with self.__lock:
+            return {name: round(seconds, 3) for name, seconds in self.__phases.items()}
+
+    def summary(self) -> str:
+        return ', '.join(f"{name} {seconds:.3f} s" for name, seconds in self.report().items())
+
+def preload(names: Iterable[str], timer: StartupTimer = None) -> threading.Thread:
+    """
+    Import modules on a background thread, so that they are ready by the
+    time the first request needs them without holding up the startup.
+    """
+    def run():
+        start = time.perf_counter()
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                logger.warning(f"Could not preload {name}: {e}")
+        if timer is not None:
+            timer.record('preload', time.perf_counter() - start)
+
+    thread = threading.Thread(target=run, name='preload', daemon=True)
+    thread.start()
+    return thread
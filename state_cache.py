@@ -0,0 +1,67 @@
+import logging
+import threading
+import time
+from typing import Dict, Tuple
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# Apple manufacturer id used by the Nuki iBeacon advertisements
+NUKI_BEACON_MANUFACTURER_ID = 76
+
+STATE_CACHE_REQUESTS = Counter('nuki_state_cache_requests_total', 'State requests answered from the cache or not', ['result'])
+
+class StateCache:
+    """
+    Last known state per device address. Entries are dropped when we change
+    the state ourselves or when the device advertises a state change.
+    """
+
+    def __init__(self):
+        self.__entries: Dict[str, Tuple[dict, float]] = {}
+        self.__lock = threading.Lock()
+
+    def get(self, address: str, max_age: float) -> Tuple[dict, float]:
+        """
+        Return the cached state and its age in seconds, or None if there is no
+        sample younger than `max_age`.
+        """
+        if not address or max_age <= 0:
+            return None
+
+        with self.__lock:
+            entry = self.__entries.get(address.upper())
+
+        if entry is None:
+            STATE_CACHE_REQUESTS.inc(result='miss')
+            return None
+
+        state, sampleTime = entry
+        age = time.monotonic() - sampleTime
+        if age > max_age:
+            STATE_CACHE_REQUESTS.inc(result='miss')
+            return None
+
+        STATE_CACHE_REQUESTS.inc(result='hit')
+        return state, age
+
+    def put(self, address: str, state: dict):
+        with self.__lock:
+            self.__entries[address.upper()] = (state, time.monotonic())
+
+    def invalidate(self, address: str):
+        with self.__lock:
+            self.__entries.pop(address.upper(), None)
+
+    def on_advertisement(self, device, advertisement_data):
+        manufacturer_data = advertisement_data.manufacturer_data.get(NUKI_BEACON_MANUFACTURER_ID)
+
+        # Only iBeacon frames carry the state flag, HomeKit ones are ignored
+        if not manufacturer_data or manufacturer_data[0] != 0x02:
+            return
+
+        # The lowest bit of the tx power byte is set when the state has changed
+        if manufacturer_data[-1] & 0x01:
+            with self.__lock:
+                if self.__entries.pop(device.address.upper(), None) is not None:
+                    logger.info(f"Device {device.address} signalled a state change")
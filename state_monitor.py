@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+from state_cache import NUKI_BEACON_MANUFACTURER_ID
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """
+    Events for one consumer. At most `max_events` events are buffered, a slow
+    consumer loses the oldest ones and is told how many were dropped.
+    """
+
+    def __init__(self, addresses: Iterable[str], max_events: int, loop: asyncio.AbstractEventLoop = None):
+        self.addresses = {a.upper() for a in addresses} if addresses else None
+        self.__events = deque()
+        self.__maxEvents = max(1, max_events)
+        self.__dropped = 0
+        self.__lock = threading.Lock()
+        self.__ready = threading.Event()
+        self.__loop = loop
+        self.__asyncReady = asyncio.Event() if loop is not None else None
+
+    def matches(self, address: str) -> bool:
+        return self.addresses is None or address in self.addresses
+
+    def push(self, event: dict):
+        with self.__lock:
+            if len(self.__events) >= self.__maxEvents:
+                self.__events.popleft()
+                self.__dropped += 1
+            self.__events.append(event)
+            self.__ready.set()
+
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__asyncReady.set)
+
+    def get(self, timeout: float) -> Tuple[List[dict], int]:
+        """
+        Wait up to `timeout` seconds for events. Returns the buffered events
+        and the number of events dropped since the last call.
+        """
+        self.__ready.wait(timeout)
+        return self.__pop_all()
+
+    async def async_get(self, timeout: float) -> Tuple[List[dict], int]:
+        """
+        Same as get() for subscriptions created with a loop.
+        """
+        try:
+            await asyncio.wait_for(self.__asyncReady.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.__asyncReady.clear()
+        return self.__pop_all()
+
+    def __pop_all(self) -> Tuple[List[dict], int]:
+        with self.__lock:
+            events = list(self.__events)
+            self.__events.clear()
+            dropped, self.__dropped = self.__dropped, 0
+            self.__ready.clear()
+        return events, dropped
+
+class StateMonitor:
+    """
+    Single source of lock state changes for all subscribers. It is fed with
+    the states read from the devices, with notifications the devices send on
+    their own and with the advertisements of the background scanner. When a
+    device signals a state change and somebody is listening, the state is
+    read once through `refresh(address)` and shared by all subscribers.
+    """
+
+    STATE_FIELDS = ('lockState', 'doorSensorState', 'batteryPercentage', 'batteryCritical', 'deviceState')
+
+    def __init__(self, is_tracked, refresh=None, buffer_size: int = 100, max_age: float = 30, refresh_interval: float = 5):
+        self.__isTracked = is_tracked
+        self.__refresh = refresh
+        self.__bufferSize = buffer_size
+        self.__maxAge = max_age
+        self.__refreshInterval = refresh_interval
+        self.__lock = threading.Lock()
+        self.__subscriptions: List[Subscription] = []
+        self.__states: Dict[str, dict] = {}
+        self.__lastSeen: Dict[str, float] = {}
+        self.__reachable: Dict[str, bool] = {}
+        self.__lastRefresh: Dict[str, float] = {}
+        self.__sweepTask = None
+
+    async def start(self):
+        if self.__sweepTask is None:
+            self.__sweepTask = asyncio.create_task(self.__sweep())
+
+    async def stop(self):
+        if self.__sweepTask is not None:
+            self.__sweepTask.cancel()
+            self.__sweepTask = None
+
+    def subscribe(self, addresses: Iterable[str] = None, loop: asyncio.AbstractEventLoop = None) -> Subscription:
+        """
+        Subscribe to the events of the given addresses (all if None). The last
+        known state and reachability of every matching device is delivered
+        right away.
+        """
+        subscription = Subscription(addresses, self.__bufferSize, loop)
+        with self.__lock:
+            self.__subscriptions.append(subscription)
+            snapshot = [self.__state_event(a, s) for a, s in self.__states.items()]
+            snapshot += [self.__reachability_event(a, r) for a, r in self.__reachable.items()]
+
+        for event in snapshot:
+            if subscription.matches(event['address']):
+                subscription.push(event)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.__lock:
+            if subscription in self.__subscriptions:
+                self.__subscriptions.remove(subscription)
+
+    def subscriber_count(self) -> int:
+        with self.__lock:
+            return len(self.__subscriptions)
+
+    def on_state(self, address: str, state: dict):
+        """
+        Publish the fields of `state` that changed since the last known state.
+        """
+        key = address.upper()
+        fields = {k: state[k] for k in self.STATE_FIELDS if k in state}
+        with self.__lock:
+            last = self.__states.get(key, {})
+            changed = {k: v for k, v in fields.items() if last.get(k) != v}
+            if not changed:
+                return
+            self.__states[key] = {**last, **fields}
+
+        self.__publish(self.__state_event(key, changed))
+
+    def on_advertisement(self, device, advertisement_data):
+        key = device.address.upper()
+        if not self.__isTracked(key):
+            return
+
+        now = time.monotonic()
+        with self.__lock:
+            self.__lastSeen[key] = now
+            becameReachable = self.__reachable.get(key) is not True
+            self.__reachable[key] = True
+
+        if becameReachable:
+            self.__publish(self.__reachability_event(key, True, advertisement_data.rssi))
+
+        manufacturer_data = advertisement_data.manufacturer_data.get(NUKI_BEACON_MANUFACTURER_ID)
+        if not manufacturer_data or manufacturer_data[0] != 0x02 or not manufacturer_data[-1] & 0x01:
+            return
+
+        # The device has a new state, read it once for everybody listening
+        if self.__refresh is None or not self.__has_subscribers(key):
+            return
+        if now - self.__lastRefresh.get(key, -self.__refreshInterval) < self.__refreshInterval:
+            return
+        self.__lastRefresh[key] = now
+        try:
+            self.__refresh(key)
+        except Exception as e:
+            logger.warning(f"Could not refresh state of {key}: {e}")
+
+    async def __sweep(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.__maxAge / 4))
+
+            now = time.monotonic()
+            with self.__lock:
+                lost = [k for k, t in self.__lastSeen.items() if now - t > self.__maxAge and self.__reachable.get(k)]
+                for key in lost:
+                    self.__reachable[key] = False
+
+            for key in lost:
+                self.__publish(self.__reachability_event(key, False))
+
+    def __has_subscribers(self, address: str) -> bool:
+        with self.__lock:
+            return any(s.matches(address) for s in self.__subscriptions)
+
+    def __publish(self, event: dict):
+        with self.__lock:
+            subscriptions = [s for s in self.__subscriptions if s.matches(event['address'])]
+
+        for subscription in subscriptions:
+            subscription.push(event)
+
+    @staticmethod
+    def __state_event(address: str, fields: dict) -> dict:
+        return {'type': 'state', 'address': address, **fields}
+
+    @staticmethod
+    def __reachability_event(address: str, reachable: bool, rssi: int = None) -> dict:
+        event = {'type': 'reachability', 'address': address, 'isReachable': reachable}
+        if rssi is not None:
+            event['rssi'] = rssi
+        return event
@@ -0,0 +1,57 @@
+import hashlib
+import json
+from typing import Dict, Iterable, List
+import pyNukiBT
+
+# Fields of a /state response, the first three describe the request
+STATE_FIELDS = ('sampleAge', 'coalesced', 'timing', 'name', 'id', 'firmwareVersion', 'hardwareRevision', 'pairingEnabled',
+    'deviceType', 'lockState', 'batteryPercentage', 'batteryCritical', 'nightmodeActive', 'lastAction', 'doorSensorState',
+    'deviceState')
+
+# Enum field of /state -> enum in pyNukiBT.NukiLockConst
+ENUM_FIELDS = {
+    'lockState': 'LockState',
+    'deviceType': 'NukiDeviceType',
+    'lastAction': 'LockAction',
+    'doorSensorState': 'DoorsensorState',
+    'deviceState': 'State',
+}
+
+class StateSchema:
+    """
+    Values of the enum fields of /state, built once from the pyNukiBT
+    constants. Serves the help tables of /state/schema and translates the
+    enum names into their numeric codes.
+    """
+
+    def __init__(self, lock_const):
+        self.__codes: Dict[str, Dict[str, int]] = {field: {str(name): code for code, name in getattr(lock_const, enum).ksymapping.items()}
+            for field, enum in ENUM_FIELDS.items()}
+
+        self.help = {f'{field}Values': ', '.join(self.__codes[field]) for field in ENUM_FIELDS}
+        self.document = {'fields': list(STATE_FIELDS), 'enums': self.__codes, 'help': self.help}
+        self.json = json.dumps(self.document, separators=(',', ':'))
+        self.etag = hashlib.sha256(self.json.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def parse_fields(value: str) -> List[str]:
+        """
+        The fields of a `fields=` projection, None if all are wanted.
+        """
+        if not value:
+            return None
+        fields = [f.strip() for f in value.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in STATE_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields {', '.join(unknown)}, choose from {', '.join(STATE_FIELDS)}")
+        return fields
+
+    def serialize(self, state: Dict[str, any], fields: Iterable[str] = None, codes: bool = False) -> Dict[str, any]:
+        if fields is not None:
+            state = {f: state[f] for f in fields if f in state}
+        if codes:
+            state = {f: self.__codes[f].get(v, v) if f in self.__codes else v for f, v in state.items()}
+        return state
+
+# Built when this module is imported, which the server does in the background at startup
+SCHEMA = StateSchema(pyNukiBT.NukiLockConst)
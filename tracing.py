@@ -0,0 +1,196 @@
+import contextlib
+import contextvars
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# The span the code that is running right now belongs to
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+# W3C trace context, e.g. 00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01
+TRACEPARENT = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: Dict[str, any] = None, start_time: int = None):
+        self.name = name
+        self.traceId = trace_id
+        self.spanId = f'{random.getrandbits(64):016x}'
+        self.parentId = parent_id
+        self.attributes = dict(attributes or {})
+        self.startTime = start_time or time.time_ns()
+        self.endTime = None
+        self.error = None
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+    def to_dict(self) -> Dict[str, any]:
+        # Field names follow the OTLP JSON encoding, attributes are kept as a plain object
+        return {
+            'traceId': self.traceId,
+            'spanId': self.spanId,
+            'parentSpanId': self.parentId,
+            'name': self.name,
+            'startTimeUnixNano': self.startTime,
+            'endTimeUnixNano': self.endTime,
+            'durationMs': round((self.endTime - self.startTime) / 1e6, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.error} if self.error is not None else {'code': 'OK'},
+        }
+
+class SpanExporter:
+    """
+    Receives finished spans on a background thread. Subclasses send them
+    wherever they are needed, e.g. to an OpenTelemetry collector.
+    """
+
+    def export(self, spans: List[Dict[str, any]]):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+class JsonFileExporter(SpanExporter):
+    """
+    Appends one JSON object per span to a file, for use without a collector.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__file = open(path, 'a', encoding='utf-8')
+
+    def export(self, spans: List[Dict[str, any]]):
+        for span in spans:
+            self.__file.write(json.dumps(span, separators=(',', ':')) + '\n')
+        self.__file.flush()
+
+    def shutdown(self):
+        self.__file.close()
+
+def create_exporter(name: str, path: str = None) -> SpanExporter:
+    """
+    `file` writes to `path`, `module:Class` creates an exporter of that
+    class without arguments.
+    """
+    if name == 'file':
+        return JsonFileExporter(path)
+    module, _, cls = name.partition(':')
+    if not cls:
+        raise ValueError(f"Unknown trace exporter {name}, use file or module:Class")
+    return getattr(importlib.import_module(module), cls)()
+
+class Tracer:
+    """
+    Records spans of the requests and of the work done on their behalf. A
+    request starts a trace with `start_trace()`, everything running in its
+    context, also in jobs of the job queue, adds child spans with `span()`.
+    Without an exporter or outside of a trace spans are skipped.
+    """
+
+    def __init__(self, exporter: SpanExporter = None):
+        self.__exporter = exporter
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace-export') if exporter is not None else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.__exporter is not None
+
+    def start_trace(self, name: str, traceparent: str = None, **attributes) -> Span:
+        """
+        Start the root span of a request and make it the current span.
+        Continues the trace of the caller if it sent a W3C `traceparent`.
+        """
+        if not self.enabled:
+            return None
+        match = TRACEPARENT.match(traceparent or '')
+        traceId, parentId = match.groups() if match else (f'{random.getrandbits(128):032x}', None)
+        span = Span(name, traceId, parentId, attributes)
+        _current_span.set(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current_span.get()
+        if parent is None or not self.enabled:
+            yield None
+            return
+
+        span = Span(name, parent.traceId, parent.spanId, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end(span)
+
+    def record(self, name: str, seconds: float, **attributes):
+        """
+        Add a child span for something that has already happened, e.g. the
+        time a job has been queued.
+        """
+        parent = _current_span.get()
+        if parent is None or not self.enabled:
+            return
+        end = time.time_ns()
+        span = Span(name, parent.traceId, parent.spanId, attributes, start_time=end - int(seconds * 1e9))
+        self.end(span, end)
+
+    def end(self, span: Span, end_time: int = None):
+        if span is None or not self.enabled:
+            return
+        span.endTime = end_time or time.time_ns()
+        try:
+            self.__executor.submit(self.__export, span.to_dict())
+        except RuntimeError:
+            # Shut down already
+            pass
+
+    def __export(self, span: Dict[str, any]):
+        try:
+            self.__exporter.export([span])
+        except Exception as e:
+            logger.warning(f"Could not export span {span['name']}: {e}")
+
+    def shutdown(self):
+        if self.enabled:
+            self.__executor.shutdown(wait=True)
+            self.__exporter.shutdown()
+
+TRACER = Tracer()
+
+def configure(exporter: SpanExporter = None):
+    """
+    Replace the global tracer, spans are exported to `exporter` from now on.
+    """
+    global TRACER
+    TRACER.shutdown()
+    TRACER = Tracer(exporter)
+
+def span(name: str, **attributes):
+    return TRACER.span(name, **attributes)
+
+def record(name: str, seconds: float, **attributes):
+    TRACER.record(name, seconds, **attributes)
+
+def shutdown():
+    TRACER.shutdown()
+
+def current_span() -> Span:
+    return _current_span.get()
+
+def current_trace_id() -> str:
+    span = _current_span.get()
+    return span.traceId if span is not None else None